@@ -0,0 +1,739 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import main
+
+DAY_MS = 24 * 3600 * 1000
+STARTUP_BUDGET = 0.15
+STARTUP_HEAVY_MODULES = ("requests", "urllib3", "rich", "asyncio", "concurrent.futures")
+STARTUP_SCRIPT = (
+    "import sys, main; "
+    "loaded = [m for m in sys.argv[1:] if m in sys.modules]; "
+    "print(','.join(loaded)); sys.exit(1 if loaded else 0)"
+)
+SUBJECTS = ("Алгебра", "Геометрия", "Русский язык", "Литература", "История", "Физика",
+            "Химия", "Биология", "География", "Английский язык", "Информатика", "Обществознание")
+LAST_NAMES = ("Иванов", "Петров", "Смирнов", "Кузнецов", "Попов", "Соколов", "Лебедев", "Козлов",
+              "Новиков", "Морозов", "Волков", "Алексеев", "Фёдоров", "Михайлов", "Беляев")
+FIRST_NAMES = ("Александр", "Мария", "Дмитрий", "Анна", "Иван", "Елена", "Сергей", "Ольга",
+               "Никита", "Софья", "Артём", "Полина", "Егор", "Дарья", "Максим")
+MARKS = ("5", "5", "4", "4", "4-", "3", "5+", "2", "н")
+HOMEWORK_HTML = ("<p>Параграф {n}, упражнения {a}&ndash;{b}.</p><ul><li>Прочитать &laquo;{subject}&raquo;</li>"
+                 "<li>Ответить на вопросы <b>1-{a}</b></li></ul><br><a href=\"https://example.org/{n}\">Материалы</a>")
+
+def school_year_start(now=None):
+    now = now or datetime.now()
+    year = now.year if now.month >= 9 else now.year - 1
+    return datetime(year, 9, 1)
+
+class MockData:
+    def __init__(self, size=1.0, seed=0):
+        self.size = size
+        self.seed = seed
+        rng = random.Random(seed)
+        start = school_year_start()
+        self.year_start = int(start.timestamp() * 1000)
+        self.year_end = int(datetime(start.year + 1, 5, 31).timestamp() * 1000)
+        self.year_id = start.year
+        self.user_id = 1
+        self.prs_id = 1000
+
+        self.groups = [
+            {"groupId": 10 + i, "groupName": f"{8 + i}А", "begDate": self.year_start - (1 - i) * 365 * DAY_MS}
+            for i in range(2)
+        ]
+        self.periods = self._build_periods()
+
+        self.units = [
+            {"unitId": 100 + i, "unitName": name, "overMark": None, "totalMark": None}
+            for i, name in enumerate(SUBJECTS)
+        ]
+        self.diary_lessons = []
+        for unit in self.units:
+            for n in range(max(1, int(20 * size))):
+                lesson_date = self.year_start + rng.randrange(0, (self.year_end - self.year_start) // DAY_MS) * DAY_MS
+                part = {"cat": rng.choice(("OTV", "KR", "SR", "DZ")), "mrkWt": rng.choice((1, 1, 1.5, 2)), "mark": []}
+                for _ in range(rng.randint(0, 2)):
+                    mark_date = datetime.fromtimestamp(lesson_date / 1000).strftime('%Y-%m-%dT10:00:00')
+                    part["mark"].append({"markValue": rng.choice(MARKS), "markDt": mark_date})
+                self.diary_lessons.append({"id": unit["unitId"] * 1000 + n, "unitId": unit["unitId"], "date": lesson_date, "part": [part]})
+
+        self.users = []
+        for i in range(max(1, int(1500 * size))):
+            fio = f"{rng.choice(LAST_NAMES)} {rng.choice(FIRST_NAMES)} {rng.choice(FIRST_NAMES)}ович"
+            is_emp = rng.random() < 0.1
+            self.users.append({
+                "prsId": self.prs_id + i,
+                "fio": fio,
+                "groupName": "" if is_emp else f"{rng.randint(1, 11)}{rng.choice('АБВГ')}",
+                "isStudent": 0 if is_emp else 1,
+                "isEmp": 1 if is_emp else 0,
+                "isParent": 0,
+            })
+
+        self.threads = []
+        self.messages = {}
+        self.unread = set()
+        now_ms = int(time.time() * 1000)
+        for i in range(max(1, int(60 * size))):
+            thread_id = 5000 + i
+            send_date = now_ms - i * 3600 * 1000
+            self.threads.append({
+                "threadId": thread_id,
+                "subject": rng.choice(("", "Родительское собрание", "Олимпиада", "Расписание")),
+                "senderFio": rng.choice(self.users)["fio"],
+                "msgPreview": "Добрый день! Напоминаем о завтрашнем занятии.",
+                "sendDate": send_date,
+            })
+            self.messages[thread_id] = [
+                {
+                    "msgId": thread_id * 1000 + n,
+                    "msgNum": n,
+                    "msg": f"<p>Сообщение {n}</p>",
+                    "senderId": rng.choice(self.users)["prsId"],
+                    "senderFio": rng.choice(self.users)["fio"],
+                    "createDate": send_date - n * 600 * 1000,
+                }
+                for n in range(max(1, int(40 * size)))
+            ]
+
+        self.groups_tree = [{
+            "orgId": 1,
+            "orgName": "Школа №1",
+            "groups": [
+                {
+                    "groupTypeId": grade,
+                    "groupTypeName": f"{grade} классы",
+                    "groups": [
+                        {"groupId": grade * 10 + n, "groupName": f"{grade}{letter}", "users": []}
+                        for n, letter in enumerate("АБВГ")
+                    ],
+                }
+                for grade in range(1, 12)
+            ],
+        }]
+        classes = {group["groupName"]: group for grade in self.groups_tree[0]["groups"] for group in grade["groups"]}
+        for user in self.users:
+            target = classes.get(user["groupName"])
+            if target is not None:
+                target["users"].append({"prsId": user["prsId"], "fio": user["fio"], "pos": [{"posTypeName": "Ученик"}]})
+
+    def _build_periods(self):
+        periods = {}
+        for group in self.groups:
+            start = group["begDate"]
+            end = start + 272 * DAY_MS
+            half = (end - start) // 2
+            items = []
+            for h in range(2):
+                half_id = group["groupId"] * 100 + h + 1
+                h_start = start + h * half
+                items.append(self._period(half_id, f"{h + 1} полугодие", h_start, h_start + half - DAY_MS))
+                for q in range(2):
+                    q_start = h_start + q * (half // 2)
+                    quarter = self._period(half_id * 10 + q + 1, f"{h * 2 + q + 1} четверть", q_start, q_start + half // 2 - DAY_MS)
+                    quarter["parentId"] = half_id
+                    items.append(quarter)
+            root = self._period(group["groupId"] * 100, "Учебный год", start, end)
+            root["items"] = items
+            periods[group["groupId"]] = root
+        return periods
+
+    @staticmethod
+    def _period(period_id, name, date1, date2):
+        return {
+            "id": period_id,
+            "name": name,
+            "date1": date1,
+            "date2": date2,
+            "date1Str": datetime.fromtimestamp(date1 / 1000).strftime('%d.%m.%Y'),
+            "date2Str": datetime.fromtimestamp(date2 / 1000).strftime('%d.%m.%Y'),
+        }
+
+    def file_content(self, file_id):
+        seed = hashlib.sha256(f"{self.seed}:{file_id}".encode()).digest()
+        return seed * (max(1, int(64 * 1024 * self.size)) // len(seed))
+
+    def prs_diary(self, d1, d2):
+        lessons = []
+        day = d1 - d1 % DAY_MS
+        while day <= d2:
+            if datetime.fromtimestamp(day / 1000).weekday() < 5:
+                rng = random.Random(f"{self.seed}:{day}")
+                for slot in range(max(1, int(6 * min(self.size, 2)))):
+                    unit = rng.choice(self.units)
+                    n = rng.randint(1, 60)
+                    lessons.append({
+                        "id": day // DAY_MS * 10 + slot,
+                        "date": day + slot * 3600 * 1000,
+                        "unit": {"id": unit["unitId"], "name": unit["unitName"]},
+                        "subject": f"Урок {n}",
+                        "part": [{
+                            "cat": "DZ",
+                            "variant": [{
+                                "id": day // DAY_MS * 100 + slot,
+                                "text": HOMEWORK_HTML.format(n=n, a=rng.randint(1, 20), b=rng.randint(21, 40), subject=unit["unitName"]),
+                                "deadLine": day + DAY_MS,
+                                "file": [{"id": n, "fileName": f"task_{n}.pdf"}] if rng.random() < 0.3 else [],
+                            }],
+                        }],
+                    })
+            day += DAY_MS
+        return {"lesson": lessons, "user": [{"prsId": self.prs_id}]}
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+class MockESchoolServer:
+    PREFIX = "/ec-server"
+    ROWS_LIMIT = 50
+
+    def __init__(self, data=None, latency=0.0, jitter=0.0, error_rate=0.0, host="127.0.0.1", port=0, seed=0):
+        self.data = data or MockData(seed=seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.sent_uids = {}
+        self.group_members = {}
+        self.routes = {
+            ("POST", "/login"): self.login,
+            ("GET", "/state"): self.state,
+            ("GET", "/usr/getClassByUser"): lambda q, b: self.data.groups,
+            ("GET", "/dict/periods/0"): lambda q, b: self.data.periods[int(q["groupId"])],
+            ("GET", "/student/getDiaryUnits/"): lambda q, b: {"result": self.data.units},
+            ("GET", "/student/getDiaryPeriod_/"): lambda q, b: {"result": self.data.diary_lessons},
+            ("GET", "/student/getPrsDiary"): lambda q, b: self.data.prs_diary(int(q["d1"]), int(q["d2"])),
+            ("GET", "/student/getPupilUnits"): lambda q, b: {"RegisterOfClass": []},
+            ("GET", "/student/getLPartListPupil"): lambda q, b: [],
+            ("GET", "/profile/getProfile_new"): self.profile,
+            ("GET", "/usr/getUserListSearch"): lambda q, b: self.data.users,
+            ("GET", "/groups/tree"): lambda q, b: self.data.groups_tree,
+            ("GET", "/chat/threads"): self.threads,
+            ("PUT", "/chat/messages"): self.messages,
+            ("PUT", "/chat/saveThread"): self.save_thread,
+            ("PUT", "/chat/setMembers"): self.set_members,
+            ("POST", "/chat/sendNew"): self.send_new,
+        }
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                server.handle(self, "GET")
+
+            def do_POST(self):
+                server.handle(self, "POST")
+
+            def do_PUT(self):
+                server.handle(self, "PUT")
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = MockHTTPServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}{self.PREFIX}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mock-eschool", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {}
+
+    def _count(self, field, value=1):
+        with self.lock:
+            self.stats[field] = self.stats.get(field, 0) + value
+
+    def client(self, session_file=None, **kwargs):
+        client = main.ESchoolAPI(session_file=session_file, **kwargs)
+        client.BASE_URL = self.url
+        return client
+
+    def handle(self, request, method):
+        parts = urlsplit(request.path)
+        path = parts.path[len(self.PREFIX):] if parts.path.startswith(self.PREFIX) else parts.path
+        query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        length = int(request.headers.get("Content-Length") or 0)
+        body = request.rfile.read(length) if length else b""
+        self._count("requests")
+
+        delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+        route = self.routes.get((method, path))
+        if route is None and method == "GET" and path.startswith("/files/"):
+            route = self.file
+        if route is None:
+            return self._send(request, 404, b"Not Found", "text/plain")
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self._count("errors")
+            return self._send(request, 503, b"Service Unavailable", "text/plain", {"Retry-After": "0"})
+        if route == self.file:
+            return self.file(request, path)
+
+        result = route(query, body)
+        if isinstance(result, tuple):
+            payload, headers = result
+        else:
+            payload, headers = result, {}
+        content = payload if isinstance(payload, bytes) else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        if method == "GET":
+            etag = '"' + hashlib.md5(content).hexdigest() + '"'
+            headers["ETag"] = etag
+            if request.headers.get("If-None-Match") == etag:
+                self._count("not_modified")
+                return self._send(request, 304, b"", None, headers)
+        content_type = "text/plain" if isinstance(payload, bytes) else "application/json;charset=UTF-8"
+        self._send(request, 200, content, content_type, headers)
+
+    def _send(self, request, status, content, content_type, headers=None):
+        request.send_response(status)
+        if content_type:
+            request.send_header("Content-Type", content_type)
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.send_header("Content-Length", str(len(content)))
+        request.end_headers()
+        if content:
+            request.wfile.write(content)
+        self._count("bytes", len(content))
+
+    def file(self, request, path):
+        content = self.data.file_content(path.rsplit("/", 1)[-1])
+        etag = '"' + hashlib.md5(content).hexdigest() + '"'
+        headers = {"ETag": etag, "Accept-Ranges": "bytes"}
+        match = re.match(r"bytes=(\d+)-$", request.headers.get("Range") or "")
+        if_range = request.headers.get("If-Range")
+        if match is None or (if_range and if_range != etag):
+            return self._send(request, 200, content, "application/octet-stream", headers)
+        start = int(match.group(1))
+        self._count("ranged")
+        if start >= len(content):
+            headers["Content-Range"] = f"bytes */{len(content)}"
+            return self._send(request, 416, b"", None, headers)
+        headers["Content-Range"] = f"bytes {start}-{len(content) - 1}/{len(content)}"
+        self._send(request, 206, content[start:], "application/octet-stream", headers)
+
+    def login(self, query, body):
+        session_id = hashlib.md5(body + str(time.time()).encode()).hexdigest().upper()
+        return b"OK-SESSION", {"Set-Cookie": f"JSESSIONID={session_id}; Path=/; HttpOnly"}
+
+    def state(self, query, body):
+        return {
+            "userId": self.data.user_id,
+            "user": {"prsId": self.data.prs_id},
+            "profile": {"firstName": "Иван", "lastName": "Иванов"},
+        }
+
+    def profile(self, query, body):
+        return {"pupil": [{"yearId": self.data.year_id, "bvt": datetime.fromtimestamp(self.data.year_start / 1000).strftime('%Y-%m-%d')}]}
+
+    def threads(self, query, body):
+        with self.lock:
+            threads = sorted(self.data.threads, key=lambda t: -t["sendDate"])
+            if query.get("newOnly") == "true":
+                threads = [t for t in threads if t["threadId"] in self.data.unread]
+        row = int(query.get("row", 0))
+        return threads[row:row + min(int(query.get("rowsCount", 20)), self.ROWS_LIMIT)]
+
+    def messages(self, query, body):
+        thread_id = int(query["threadId"])
+        with self.lock:
+            messages = list(self.data.messages.get(thread_id, []))
+            self.data.unread.discard(thread_id)
+        row = int(query.get("rowStart", 0))
+        return messages[row:row + min(int(query.get("rowsCount", 25)), self.ROWS_LIMIT)]
+
+    def save_thread(self, query, body):
+        data = json.loads(body)
+        self._count("save_thread")
+        if data.get("isGroup"):
+            with self.lock:
+                thread_id = 900000 + len(self.group_members)
+                self.group_members[thread_id] = []
+            return thread_id
+        return 500000 + int(data["interlocutor"])
+
+    def set_members(self, query, body):
+        with self.lock:
+            self.group_members[int(query["threadId"])] = [member["memberObjId"] for member in json.loads(body)]
+        return b""
+
+    def send_new(self, query, body):
+        fields = dict(re.findall(rb'name="(\w+)"\r\n\r\n(.*?)\r\n--', body, re.S))
+        msg_uid = fields[b"msgUID"].decode()
+        with self.lock:
+            self.sent_uids[msg_uid] = self.sent_uids.get(msg_uid, 0) + 1
+        if self.sent_uids[msg_uid] > 1:
+            self._count("duplicate_sends")
+        message = self._append(int(fields[b"threadId"]), fields[b"msgText"].decode("utf-8"), "Иванов Иван", owner=True)
+        return {"msgId": message["msgId"]}
+
+    def deliver(self, thread_id, text, sender_fio="Учитель"):
+        self._append(thread_id, text, sender_fio)
+        with self.lock:
+            self.data.unread.add(thread_id)
+
+    def _append(self, thread_id, text, sender_fio, owner=False):
+        with self.lock:
+            messages = self.data.messages.setdefault(thread_id, [])
+            now_ms = int(time.time() * 1000)
+            num = max((m["msgNum"] for m in messages), default=-1) + 1
+            message = {
+                "msgId": thread_id * 1000 + num, "msgNum": num, "msg": text,
+                "senderId": self.data.prs_id if owner else 0, "senderFio": sender_fio, "createDate": now_ms,
+            }
+            if owner:
+                message["isOwner"] = True
+            messages.insert(0, message)
+            for thread in self.data.threads:
+                if thread["threadId"] == thread_id:
+                    thread["sendDate"] = now_ms
+                    thread["msgPreview"] = text
+            return message
+
+class BenchContext:
+    def __init__(self, server, workdir, cache=False):
+        self.server = server
+        self.workdir = workdir
+        self.cache = cache
+        self.client = self.new_client()
+        self.client.login("bench", "bench")
+        self.aclient = main.AsyncESchoolAPI(self.client)
+
+    def new_client(self):
+        client = self.server.client(session_file=os.path.join(self.workdir, "session.json"))
+        if self.cache:
+            client.cache = main.ResponseCache(os.path.join(self.workdir, "cache"))
+        return client
+
+    def close(self):
+        self.aclient.close()
+
+def bench_login(ctx):
+    client = ctx.new_client()
+    if not client.login("bench", "bench"):
+        raise RuntimeError("login failed")
+    client.session.close()
+
+def bench_periods(ctx):
+    if not main.load_period_options(ctx.aclient):
+        raise RuntimeError("no periods")
+
+def bench_diary(ctx):
+    period = main.find_current_option(main.load_period_options(ctx.aclient))
+    period_id = period.period_id if period is not None else 0
+    units, details = ctx.aclient.run(ctx.aclient.get_diary_units(period_id), ctx.aclient.get_diary_period(period_id))
+    units = [main.Unit.from_json(u) for u in units.get('result', [])]
+    lessons = [main.Lesson.from_json(l) for l in details.get('result', [])]
+    for marks in main.collect_marks(lessons).values():
+        main.weighted_average(marks)
+        main.averages_by_type(marks)
+        main.moving_average(marks)
+    return units
+
+def bench_homework(ctx):
+    data = ctx.server.data
+    rows = 0
+    for _, diary_data in ctx.client.iter_prs_diary(data.year_start, data.year_end):
+        for lesson_data in diary_data.get('lesson', []):
+            lesson = main.Lesson.from_json(lesson_data)
+            for part in lesson.parts:
+                for variant in part.variants:
+                    main.clean_html(variant.text)
+                    rows += 1
+    return rows
+
+def bench_attachments(ctx):
+    data = ctx.server.data
+    files = []
+    for _, diary_data in ctx.client.iter_prs_diary(data.year_start, data.year_start + 60 * DAY_MS):
+        for lesson_data in diary_data.get('lesson', []):
+            for part in main.Lesson.from_json(lesson_data).parts:
+                for variant in part.variants:
+                    files.extend(("HOMEWORK_VARIANT", f.variant_id, f.file_id, f.name) for f in variant.files)
+    store = main.AttachmentStore(os.path.join(ctx.workdir, f"files-{time.monotonic_ns()}"))
+    downloader = main.AttachmentDownloader(ctx.client, store)
+    for _, meta, error in downloader.fetch_many(files):
+        if error is not None:
+            raise error
+    return downloader.downloaded_bytes
+
+def legacy_clean_html(raw_html):
+    if not raw_html:
+        return ""
+    cleanr = re.compile('<.*?>')
+    text = raw_html.replace('<br>', '\n').replace('</p>', '\n').replace('<p>', '')
+    text = re.sub(cleanr, '', text)
+    return text.strip()
+
+def homework_texts(ctx):
+    texts = ctx.__dict__.get("homework_texts")
+    if texts is None:
+        data = ctx.server.data
+        lessons = data.prs_diary(data.year_start, data.year_end)["lesson"]
+        texts = ctx.homework_texts = [v["text"] for l in lessons for p in l["part"] for v in p["variant"]]
+    return texts
+
+def bench_html(ctx):
+    main.clean_html.cache_clear()
+    main.html_tokens.cache_clear()
+    for text in homework_texts(ctx):
+        main.clean_html(text)
+
+def bench_html_warm(ctx):
+    for text in homework_texts(ctx):
+        main.clean_html(text)
+
+def bench_html_legacy(ctx):
+    for text in homework_texts(ctx):
+        legacy_clean_html(text)
+
+def bench_chats(ctx):
+    store = main.ChatStore("bench", os.path.join(ctx.workdir, f"chats-{time.monotonic_ns()}.db"))
+    try:
+        sync = main.ChatSync(ctx.client, store)
+        changed = sync.sync_threads()
+        for thread_id in changed[:10]:
+            sync.sync_thread(thread_id)
+        return [main.Thread.from_json(t) for t in store.threads()]
+    finally:
+        store.close()
+
+def bench_history(ctx):
+    data = ctx.server.data
+    threads = list(ctx.client.iter_threads())
+    if len(threads) != len(data.threads):
+        raise RuntimeError(f"iter_threads вернул {len(threads)} из {len(data.threads)} чатов")
+    for thread in threads[:10]:
+        count = sum(1 for _ in ctx.client.iter_messages(thread["threadId"]))
+        if count != len(data.messages[thread["threadId"]]):
+            raise RuntimeError(f"iter_messages вернул {count} из {len(data.messages[thread['threadId']])} сообщений")
+    return threads
+
+def bench_directory(ctx):
+    directory = main.UserDirectory(ctx.server.data.year_id, directory=os.path.join(ctx.workdir, "directory"))
+    directory.update(ctx.client.get_user_list_search(ctx.client.current_year_id(), stream=True))
+    directory.save()
+    return directory
+
+def bench_search(ctx):
+    directory = ctx.__dict__.get("directory")
+    if directory is None:
+        directory = ctx.directory = bench_directory(ctx)
+    for query in ("иван", "петров м", "смирн", "ольга 9а", "кузнецов дмитрий"):
+        directory.search(query)
+    directory.search("", role="teacher")
+
+def bench_chat_search(ctx):
+    store = ctx.__dict__.get("chat_store")
+    if store is None:
+        store = ctx.chat_store = main.ChatStore("bench", os.path.join(ctx.workdir, "chat-search.db"))
+        main.ChatSync(ctx.client, store).sync_threads()
+        main.ChatSync(ctx.client, store).sync_all_history()
+    for query in ("сообщение", "сообщения 12", "олимпиада", "волков"):
+        store.search(query)
+
+def bench_startup(ctx):
+    result = subprocess.run(
+        [sys.executable, "-c", STARTUP_SCRIPT, *STARTUP_HEAVY_MODULES],
+        cwd=os.path.dirname(os.path.abspath(main.__file__)), capture_output=True, text=True
+    )
+    if result.returncode:
+        raise RuntimeError(f"импорт main.py загружает тяжелые модули: {result.stdout.strip() or result.stderr.strip()}")
+
+def bench_school_tree(ctx):
+    tree = main.SchoolTree(ctx.client.get_groups_tree())
+    tree.search("иванов")
+    return tree.search("9а")
+
+BENCHMARKS = {
+    "startup": bench_startup,
+    "login": bench_login,
+    "periods": bench_periods,
+    "diary": bench_diary,
+    "homework": bench_homework,
+    "attachments": bench_attachments,
+    "html": bench_html,
+    "html_warm": bench_html_warm,
+    "html_legacy": bench_html_legacy,
+    "chats": bench_chats,
+    "history": bench_history,
+    "directory": bench_directory,
+    "search": bench_search,
+    "chat_search": bench_chat_search,
+    "school_tree": bench_school_tree,
+}
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+def run_benchmark(name, func, ctx, repeat, warmup):
+    for _ in range(warmup):
+        func(ctx)
+    ctx.server.reset_stats()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(ctx)
+        samples.append(time.perf_counter() - started)
+    stats = dict(ctx.server.stats)
+    median = statistics.median(samples)
+    return {
+        "name": name,
+        "repeat": repeat,
+        "min": min(samples),
+        "median": median,
+        "mean": statistics.fmean(samples),
+        "p95": percentile(samples, 0.95),
+        "ops_per_sec": 1 / median if median else 0.0,
+        "requests": stats.get("requests", 0) / repeat,
+        "bytes": stats.get("bytes", 0) / repeat,
+        "errors": stats.get("errors", 0) / repeat,
+    }
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for result in results:
+        previous = baseline.get(result["name"])
+        if not previous or not previous.get("median"):
+            result["change"] = None
+            continue
+        change = result["median"] / previous["median"] - 1
+        result["change"] = change
+        if change > threshold:
+            regressions.append(result["name"])
+    return regressions
+
+def format_results(results, args):
+    lines = [
+        f"mock eSchool: latency={args.latency * 1000:.0f}ms jitter={args.jitter * 1000:.0f}ms "
+        f"errors={args.error_rate:.0%} size={args.size} cache={'on' if args.cache else 'off'}",
+        f"{'benchmark':<12} {'median':>10} {'min':>10} {'p95':>10} {'ops/s':>8} {'req':>7} {'KiB':>9} {'vs base':>8}",
+    ]
+    for r in results:
+        change = r.get("change")
+        change_str = "" if change is None else f"{change:+.0%}"
+        lines.append(
+            f"{r['name']:<12} {r['median'] * 1000:>8.1f}ms {r['min'] * 1000:>8.1f}ms {r['p95'] * 1000:>8.1f}ms "
+            f"{r['ops_per_sec']:>8.1f} {r['requests']:>7.1f} {r['bytes'] / 1024:>9.1f} {change_str:>8}"
+        )
+    return "\n".join(lines)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарки eSchool CLI на локальном mock-сервере")
+    parser.add_argument("benchmarks", nargs="*", help="какие бенчмарки запускать: " + ",".join(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=5, help="число замеров на бенчмарк")
+    parser.add_argument("--warmup", type=int, default=1, help="число прогревочных запусков")
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа сервера, секунды")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, секунды")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503 (0..1)")
+    parser.add_argument("--size", type=float, default=1.0, help="множитель объема данных")
+    parser.add_argument("--seed", type=int, default=0, help="seed генератора данных")
+    parser.add_argument("--cache", action="store_true", help="включить кэш ответов в клиенте")
+    parser.add_argument("--save", help="сохранить результаты в JSON-файл")
+    parser.add_argument("--baseline", help="JSON-файл с прошлыми результатами для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимый рост медианы относительно baseline")
+    parser.add_argument("--startup-budget", type=float, default=STARTUP_BUDGET,
+                        help="максимальная медиана холодного старта (startup), секунды")
+    parser.add_argument("--output", help="файл для текстового отчета (по умолчанию stdout)")
+    parser.add_argument("--serve", action="store_true", help="только запустить mock-сервер и ждать Ctrl+C")
+    parser.add_argument("--port", type=int, default=0, help="порт mock-сервера (0 - любой свободный)")
+    return parser.parse_args(argv)
+
+def run(argv=None):
+    args = parse_args(argv)
+    names = args.benchmarks or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        print(f"Неизвестные бенчмарки: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+
+    data = MockData(size=args.size, seed=args.seed)
+    server = MockESchoolServer(data, latency=args.latency, jitter=args.jitter,
+                               error_rate=args.error_rate, port=args.port, seed=args.seed)
+    with server, tempfile.TemporaryDirectory(prefix="eschool-bench-") as workdir:
+        if args.serve:
+            print(f"mock eSchool: {server.url}")
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                return 0
+
+        ctx = BenchContext(server, workdir, cache=args.cache)
+        try:
+            results = [run_benchmark(name, BENCHMARKS[name], ctx, args.repeat, args.warmup) for name in names]
+        finally:
+            ctx.close()
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = {r["name"]: r for r in json.load(f)["results"]}
+        regressions = compare(results, baseline, args.threshold)
+    regressions.extend(
+        r["name"] for r in results if r["name"] == "startup" and r["median"] > args.startup_budget
+    )
+
+    report = format_results(results, args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({"config": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+
+    if regressions:
+        print(f"Регрессия производительности: {', '.join(regressions)}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -1,26 +1,204 @@
-import requests
+import functools
+import importlib
 import hashlib
 import json
+import codecs
 import time
 import random
 import string
 import os
 import re
+import shutil
+import threading
+import math
+import bisect
+import heapq
+from array import array
+from itertools import islice
+from contextlib import contextmanager
+import sqlite3
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from rich.console import Console
-from rich.panel import Panel
-from rich.table import Table
-from rich.prompt import Prompt, Confirm
-from rich.text import Text
-from rich import box
 import sys
+import argparse
+from dataclasses import dataclass
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class LazyObject:
+    __slots__ = ('_factory', '_target')
+    _lock = threading.RLock()
+
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_target', None)
+
+    def _resolve(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    object.__setattr__(self, '_target', self._factory())
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+def lazy_import(module, name=None):
+    def load():
+        target = importlib.import_module(module)
+        return getattr(target, name) if name else target
+    return LazyObject(load)
+
+def lazy_re(pattern, flags=0):
+    return LazyObject(functools.partial(re.compile, pattern, flags))
+
+requests = lazy_import("requests")
+HTTPAdapter = lazy_import("requests.adapters", "HTTPAdapter")
+asyncio = lazy_import("asyncio")
+html = lazy_import("html")
+uuid = lazy_import("uuid")
+Future = lazy_import("concurrent.futures", "Future")
+ThreadPoolExecutor = lazy_import("concurrent.futures", "ThreadPoolExecutor")
+as_completed = lazy_import("concurrent.futures", "as_completed")
+Console = lazy_import("rich.console", "Console")
+Panel = lazy_import("rich.panel", "Panel")
+Table = lazy_import("rich.table", "Table")
+Prompt = lazy_import("rich.prompt", "Prompt")
+Confirm = lazy_import("rich.prompt", "Confirm")
+Text = lazy_import("rich.text", "Text")
+box = lazy_import("rich.box")
+
+CHAT_DB_FILE = "eschool_chats.db"
+CHAT_WATCH_FOCUSED_INTERVAL = 5.0
+CHAT_WATCH_MIN_INTERVAL = 15.0
+CHAT_WATCH_MAX_INTERVAL = 300.0
+CHAT_WATCH_BACKOFF = 1.5
+OUTBOX_WORKERS = 4
+OUTBOX_RATE = 5.0
+OUTBOX_POLL_INTERVAL = 30.0
+OUTBOX_RETRY_BASE = 5.0
+OUTBOX_RETRY_MAX = 300.0
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_DEDUPE_WINDOW = 20
+OUTBOX_AUTH_STATUSES = {401, 403}
+OUTBOX_AMBIGUOUS_STATUSES = {502, 504}
+CHAT_OPEN_WORKERS = 8
+CHAT_HISTORY_CHUNK = 200
+PAGE_SIZE_MIN = 10
+PAGE_SIZE_MAX = 200
+PAGE_TARGET_LATENCY = 1.0
+CACHE_DIR = "eschool_cache"
+CACHE_MAX_BYTES = 50 * 1024 * 1024
+CACHE_TTLS = {
+    "/state": 0,
+    "/dict/periods/0": 7 * 24 * 3600,
+    "/usr/getClassByUser": 7 * 24 * 3600,
+    "/groups/tree": 24 * 3600,
+    "/profile/getProfile_new": 24 * 3600,
+    "/student/getPupilUnits": 24 * 3600,
+    "/student/getDiaryUnits/": 0,
+    "/student/getDiaryPeriod_/": 0,
+    "/student/getPrsDiary": 0,
+}
+
+MARK_VALUE_RE = re.compile(r'\d+(?:[.,]\d+)?')
+TARGET_AVERAGE = 4.5
+MOVING_AVERAGE_WINDOW = 5
+PRS_DIARY_WINDOW_DAYS = 14
+PRS_DIARY_WORKERS = 4
+PRS_DIARY_SETTLE = 24 * 3600
+PRS_DIARY_PAST_TTL = 30 * 24 * 3600
+STREAM_CHUNK_SIZE = 64 * 1024
+DIRECTORY_DIR = "eschool_directory"
+DIRECTORY_MAX_AGE = 24 * 3600
+JSON_NUMBER_CHARS = frozenset("0123456789.eE+-")
+DIRECTORY_NON_WORD_RE = re.compile(r'[^\w]+')
+DOWNLOADS_DIR = "eschool_files"
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+CONTENT_RANGE_RE = re.compile(r'bytes (?:(\d+)-\d+|\*)/(\d+|\*)')
+EXPORT_NAME_RE = re.compile(r'[\\/:*?"<>|\x00-\x1f]+')
+HTML_SKIP_RE = re.compile(r'<!--.*?(?:-->|$)|<(?i:script|style)\b.*?(?:</(?i:script|style)\s*>|$)|<[!?][^>]*>', re.S)
+HTML_TAG_RE = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9]*)[^>]*>')
+HTML_TAG_TOKEN_RE = lazy_re(
+    r'(/?)([a-zA-Z][a-zA-Z0-9]*)(?:\s+[^\s"\'<>/=]+(?:\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s"\'<>=`]+))?)*\s*/?'
+)
+HTML_COMMON_ENTITIES = (
+    ('&nbsp;', '\xa0'), ('&laquo;', '«'), ('&raquo;', '»'), ('&ndash;', '–'), ('&mdash;', '—'),
+    ('&quot;', '"'), ('&lt;', '<'), ('&gt;', '>'),
+)
+HTML_BLANK_LINES_RE = re.compile(r'\n{3,}')
+HTML_INDENT = '\x01'
+HTML_TAG_TEXT = {
+    prefix + tag: '\n'
+    for tag in ('p', 'div', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'tr', 'table', 'blockquote', 'pre', 'hr',
+                'section', 'article', 'header', 'footer', 'br')
+    for prefix in ('', '/')
+}
+HTML_TAG_TEXT.update({'tr': '', '/ul': '\n', '/ol': '\n', '/td': ' ', '/th': ' '})
+HTML_STATEFUL_TAGS = frozenset(('ul', 'ol', 'li', 'script', 'style'))
+HTML_TOKEN_CACHE_SIZE = 4096
+HTML_CACHE_SIZE = 4096
+STEM_RV_RE = lazy_re(r'^(.*?[аеиоуыэюя])(.*)$')
+STEM_PERFECTIVE_RE = lazy_re(r'((ив|ивши|ившись|ыв|ывши|ывшись)|((?<=[ая])(в|вши|вшись)))$')
+STEM_REFLEXIVE_RE = lazy_re(r'(с[яь])$')
+STEM_ADJECTIVE_RE = lazy_re(r'(ее|ие|ые|ое|ими|ыми|ей|ий|ый|ой|ем|им|ым|ом|его|ого|ему|ому|их|ых|ую|юю|ая|яя|ою|ею)$')
+STEM_PARTICIPLE_RE = lazy_re(r'((ивш|ывш|ующ)|((?<=[ая])(ем|нн|вш|ющ|щ)))$')
+STEM_VERB_RE = lazy_re(
+    r'((ила|ыла|ена|ейте|уйте|ите|или|ыли|ей|уй|ил|ыл|им|ым|ен|ило|ыло|ено|ят|ует|уют|ит|ыт|ены|ить|ыть|ишь|ую|ю)'
+    r'|((?<=[ая])(ла|на|ете|йте|ли|й|л|ем|н|ло|но|ет|ют|ны|ть|ешь|нно)))$'
+)
+STEM_NOUN_RE = lazy_re(
+    r'(а|ев|ов|ие|ье|е|иями|ями|ами|еи|ии|и|ией|ей|ой|ий|й|иям|ям|ием|ем|ам|ом|о|у|ах|иях|ях|ы|ь|ию|ью|ю|ия|ья|я)$'
+)
+STEM_DERIVATIONAL_RE = lazy_re(r'[^аеиоуыэюя]+[аеиоуыэюя].*ость?$')
+STEM_SUPERLATIVE_RE = lazy_re(r'(ейше|ейш)$')
+STEM_CACHE_SIZE = 65536
+CHAT_SEARCH_LIMIT = 20
+SEARCH_WORD_RE = re.compile(r'\w+')
+SEARCH_STOP_WORDS = frozenset(
+    "и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было вот от "
+    "меня еще нет о из ему когда даже ну ли если уже или ни быть был него до вас нибудь опять уж вам ведь там "
+    "потом себя ничего ей может они тут где есть надо ней для мы тебя их чем была сам чтоб без будто чего раз "
+    "тоже себе под будет ж тогда кто этот того потому этого какой ним здесь этом один почти мой тем чтобы нее "
+    "были куда зачем всех никогда можно при об другой хоть после над больше тот через эти нас про всего них "
+    "какая много разве эту моя впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой им более "
+    "всегда конечно всю между".split()
+)
+USER_ROLES = (('isStudent', 'student'), ('isEmp', 'teacher'), ('isParent', 'parent'))
+SESSION_POOL_DIR = "eschool_sessions"
+SESSION_MAX_AGE = 12 * 3600
+RETRY_STATUSES = {429, 502, 503, 504}
+UNSAFE_RETRY_STATUSES = {429, 503}
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class ESchoolAPIError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
 
 class ESchoolAPI:
     BASE_URL = "https://app.eschool.center/ec-server"
     SESSION_FILE = "eschool_session.json"
+    POOL_SIZE = 10
 
-    def __init__(self):
+    def __init__(self, pool_size=POOL_SIZE, session_file=None):
+        self.session_file = session_file or self.SESSION_FILE
         self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
             'Accept': 'application/json, text/plain, */*',
@@ -40,6 +218,45 @@ class ESchoolAPI:
         self.prs_id = None
         self.session_id = None
         self.profile_data = None
+        self.cache = None
+        self.offline = False
+        self._memo = {}
+        self._memo_lock = threading.Lock()
+        self.rate_limiter = None
+        self.circuit_breaker = CircuitBreaker()
+        self.hooks = []
+
+    def _emit(self, event, **data):
+        for hook in self.hooks:
+            hook(event, data)
+
+    @contextmanager
+    def screen(self, name):
+        started = time.time()
+        self._emit("screen_start", name=name, start=started)
+        try:
+            yield
+        finally:
+            self._emit("screen_end", name=name, start=started, duration=time.time() - started)
+
+    def _memoized(self, key, loader):
+        with self._memo_lock:
+            if key in self._memo:
+                return self._memo[key]
+        value = loader()
+        with self._memo_lock:
+            self._memo[key] = value
+        return value
+
+    def invalidate(self, *keys):
+        with self._memo_lock:
+            if not keys:
+                self._memo.clear()
+                return
+            for memo_key in list(self._memo):
+                name = memo_key[0] if isinstance(memo_key, tuple) else memo_key
+                if name in keys:
+                    del self._memo[memo_key]
 
     def _generate_random_string(self, length):
         return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
@@ -54,21 +271,24 @@ class ESchoolAPI:
         data = {
             "username": username,
             "password_hash": password_hash,
-            "device_payload": device_payload
+            "device_payload": device_payload,
+            "session_id": self.session_id,
+            "session_expires_at": time.time() + SESSION_MAX_AGE if self.session_id else None
         }
         try:
-            with open(self.SESSION_FILE, 'w', encoding='utf-8') as f:
+            with open(self.session_file, 'w', encoding='utf-8') as f:
                 json.dump(data, f, indent=4)
-        except Exception as e:
-            pass 
+        except OSError as e:
+            self._emit("error", source="save_session_data", error=str(e))
 
     def load_session_data(self):
-        if not os.path.exists(self.SESSION_FILE):
+        if not os.path.exists(self.session_file):
             return None
         try:
-            with open(self.SESSION_FILE, 'r', encoding='utf-8') as f:
+            with open(self.session_file, 'r', encoding='utf-8') as f:
                 return json.load(f)
-        except:
+        except (OSError, ValueError) as e:
+            self._emit("error", source="load_session_data", error=str(e))
             return None
 
     def auto_login(self):
@@ -83,11 +303,42 @@ class ESchoolAPI:
         if not all([username, password_hash, device_payload]):
             return False
 
-        return self._perform_login_request(username, password_hash, device_payload)
+        if self.offline:
+            self.username = username
+            return True
+
+        if self.resume_session(username, data.get("session_id"), data.get("session_expires_at")):
+            self.save_session_data(username, password_hash, device_payload)
+            return True
+
+        success = self._perform_login_request(username, password_hash, device_payload)
+        if success:
+            self.save_session_data(username, password_hash, device_payload)
+        return success
+
+    def resume_session(self, username, session_id, expires_at=None):
+        if not session_id or (expires_at and expires_at < time.time()):
+            return False
+        self.invalidate()
+        self.username = username
+        self.session_id = session_id
+        self.session.cookies.set('JSESSIONID', session_id, domain='app.eschool.center')
+        try:
+            state = self._json(self._request("GET", "/state"), "/state")
+        except Exception:
+            state = None
+        if not isinstance(state, dict) or not state.get('userId'):
+            self.session_id = None
+            self.session.cookies.clear()
+            return False
+        self._memoized("state", lambda: state)
+        return True
 
     def login(self, username, password):
         password_hash = hashlib.sha256(password.encode('utf-8')).hexdigest()
-        
+        return self.login_with_hash(username, password_hash)
+
+    def login_with_hash(self, username, password_hash):
         device_id = self._generate_random_string(32)
         push_token = self._generate_random_string(64)
 
@@ -108,6 +359,7 @@ class ESchoolAPI:
         return success
 
     def _perform_login_request(self, username, password_hash, device_payload):
+        self.invalidate()
         self.username = username
         data = {
             "username": username,
@@ -116,13 +368,10 @@ class ESchoolAPI:
         }
 
         try:
-            response = self.session.post(f"{self.BASE_URL}/login", data=data)
+            response = self._request("POST", "/login", idempotent=True, data=data)
             
             if response.status_code != 200:
-                 error_text = response.text
-                 if "503" in error_text:
-                     raise Exception("Сервер временно недоступен (503). Попробуйте позже.")
-                 raise Exception(f"HTTP Error {response.status_code}")
+                 raise ESchoolAPIError(f"HTTP Error {response.status_code}", response.status_code)
 
             if 'Set-Cookie' in response.headers:
                 cookies = response.headers['Set-Cookie']
@@ -144,162 +393,2401 @@ class ESchoolAPI:
 
             return False
 
-        except Exception as e:
-            if "HTTP Error" in str(e) or "503" in str(e):
-                raise e
+        except ESchoolAPIError as e:
+            if e.status_code is not None:
+                raise
             return False
 
-    def get_state(self):
-        response = self.session.get(f"{self.BASE_URL}/state", headers=self._get_headers())
+    def _request(self, method, path, headers=None, route=None, idempotent=None, **kwargs):
+        route = route or path
+        if self.offline:
+            raise ESchoolAPIError(f"Офлайн-режим: запрос {path} недоступен")
+        if idempotent is None:
+            idempotent = method != "POST"
+        request_headers = self._get_headers()
+        if headers:
+            request_headers.update(headers)
+
+        if not self.circuit_breaker.allow():
+            raise ESchoolAPIError("Сервер временно недоступен (503), запросы приостановлены. Попробуйте позже.", 503)
+        healthy = False
+        try:
+            for attempt in range(MAX_RETRIES + 1):
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire()
+
+                retry_after = None
+                started = time.perf_counter()
+                try:
+                    response = self.session.request(method, f"{self.BASE_URL}{path}", headers=request_headers, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    self._emit("request", method=method, path=route, status=None,
+                               duration=time.perf_counter() - started, bytes=0, attempt=attempt, error=str(e))
+                    error = ESchoolAPIError(f"Нет соединения с сервером: {e}")
+                    retryable = idempotent
+                else:
+                    self._emit("request", method=method, path=route, status=response.status_code,
+                               duration=time.perf_counter() - started,
+                               bytes=0 if kwargs.get('stream') else len(response.content), attempt=attempt, error=None)
+                    if response.status_code not in RETRY_STATUSES:
+                        healthy = response.status_code < 500
+                        if healthy and self.rate_limiter is not None:
+                            self.rate_limiter.recover()
+                        return response
+                    if response.status_code == 503:
+                        error = ESchoolAPIError("Сервер временно недоступен (503). Попробуйте позже.", 503)
+                    else:
+                        error = ESchoolAPIError(f"HTTP Error {response.status_code}", response.status_code)
+                    retry_after = response.headers.get('Retry-After')
+                    retryable = idempotent or response.status_code in UNSAFE_RETRY_STATUSES
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.throttle()
+
+                if not retryable or attempt == MAX_RETRIES:
+                    break
+                delay = self._backoff_delay(attempt, retry_after)
+                self._emit("retry", path=route, attempt=attempt + 1, delay=delay, status=error.status_code)
+                time.sleep(delay)
+            raise error
+        except requests.RequestException as e:
+            raise ESchoolAPIError(f"Ошибка запроса {path}: {e}") from e
+        finally:
+            if healthy:
+                self.circuit_breaker.record_success()
+            else:
+                self.circuit_breaker.record_failure()
+
+    def _backoff_delay(self, attempt, retry_after=None):
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+        if retry_after and str(retry_after).isdigit():
+            delay = max(delay, min(BACKOFF_MAX, int(retry_after)))
+        return delay
+
+    def _json(self, response, path):
         if response.status_code != 200:
-            raise Exception(f"Ошибка получения профиля: {response.status_code}")
-        data = response.json()
+            raise ESchoolAPIError(f"Ошибка запроса {path}: HTTP {response.status_code}", response.status_code)
+        started = time.perf_counter()
+        try:
+            return response.json()
+        except ValueError:
+            raise ESchoolAPIError(f"Некорректный ответ сервера на {path}", response.status_code)
+        finally:
+            self._emit("decode", path=path, duration=time.perf_counter() - started)
+
+    def _loads(self, body, path):
+        started = time.perf_counter()
+        try:
+            return json.loads(body)
+        finally:
+            self._emit("decode", path=path, duration=time.perf_counter() - started)
+
+    def _stream_json(self, path, params=None, item_path=()):
+        response = self._request("GET", path, params=params, stream=True)
+        received = 0
+
+        def chunks():
+            nonlocal received
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                received += len(chunk)
+                yield chunk
+
+        try:
+            if response.status_code != 200:
+                raise ESchoolAPIError(f"Ошибка запроса {path}: HTTP {response.status_code}", response.status_code)
+            try:
+                yield from iter_json_items(chunks(), item_path)
+            except ValueError:
+                raise ESchoolAPIError(f"Некорректный ответ сервера на {path}", response.status_code)
+        finally:
+            response.close()
+            self._emit("bytes", path=path, bytes=received)
+
+    def _get_json(self, path, params=None, ttl=None):
+        if ttl is None:
+            ttl = CACHE_TTLS.get(path)
+        if self.cache is None or ttl is None:
+            return self._json(self._request("GET", path, params=params), path)
+
+        key = self.cache.key(self.username, path, params)
+        entry = self.cache.get(key)
+        if entry is not None and (self.offline or time.time() - entry['stored_at'] < ttl):
+            try:
+                data = self._loads(entry['body'], path)
+            except ValueError:
+                self.cache.drop(key)
+                entry = None
+            else:
+                self._emit("cache", path=path, result="hit")
+                return data
+        if self.offline:
+            self._emit("cache", path=path, result="miss")
+            raise ESchoolAPIError(f"Офлайн-режим: нет сохраненных данных для {path}")
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            response = self._request("GET", path, params=params, headers=headers)
+        except ESchoolAPIError as error:
+            if entry is None:
+                raise
+            try:
+                data = self._loads(entry['body'], path)
+            except ValueError:
+                self.cache.drop(key)
+                raise error from None
+            self._emit("cache", path=path, result="stale")
+            return data
+        if response.status_code == 304 and entry is not None:
+            try:
+                data = self._loads(entry['body'], path)
+            except ValueError:
+                self.cache.drop(key)
+                return self._get_json(path, params, ttl)
+            self.cache.touch(key)
+            self._emit("cache", path=path, result="revalidated")
+            return data
+        self._emit("cache", path=path, result="miss")
+        data = self._json(response, path)
+        self.cache.put(key, response.content, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return data
+
+    def get_state(self, refresh=False):
+        if refresh:
+            self.invalidate("state", "profile_new", "year_id")
+        data = self._memoized("state", lambda: self._get_json("/state"))
         self.user_id = data.get('userId')
         self.prs_id = data.get('user', {}).get('prsId')
         self.profile_data = data.get('profile')
         return data
 
     def get_threads(self, new_only=False, row=0, rows_count=20):
-        url = f"{self.BASE_URL}/chat/threads"
         params = {
             "newOnly": str(new_only).lower(),
             "row": row,
             "rowsCount": rows_count
         }
-        response = self.session.get(url, params=params, headers=self._get_headers())
-        return response.json()
+        return self._get_json("/chat/threads", params)
 
-    def get_messages(self, thread_id, row_start=0, rows_count=25):
-        url = f"{self.BASE_URL}/chat/messages"
+    def get_messages(self, thread_id, row_start=0, rows_count=25, get_new=False):
         params = {
-            "getNew": "false",
+            "getNew": str(get_new).lower(),
             "isSearch": "false",
             "rowStart": row_start,
             "rowsCount": rows_count,
             "threadId": thread_id
         }
         payload = {"msgNums": None, "searchText": None}
-        response = self.session.put(url, params=params, json=payload, headers=self._get_headers())
-        return response.json()
+        response = self._request("PUT", "/chat/messages", params=params, json=payload)
+        return self._json(response, "/chat/messages")
+
+    def iter_threads(self, new_only=False, cutoff=None, page_size=20):
+        def fetch(row, rows_count):
+            return self.get_threads(new_only=new_only, row=row, rows_count=rows_count)
+        return self._iter_pages(fetch, 'sendDate', cutoff, page_size)
+
+    def iter_messages(self, thread_id, cutoff=None, page_size=25):
+        def fetch(row, rows_count):
+            return self.get_messages(thread_id, row_start=row, rows_count=rows_count)
+        return self._iter_pages(fetch, 'createDate', cutoff, page_size)
+
+    def _iter_pages(self, fetch, date_field, cutoff, page_size):
+        def timed_fetch(row, rows_count):
+            started = time.monotonic()
+            page = fetch(row, rows_count)
+            return page, time.monotonic() - started
+
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="eschool-prefetch")
+        try:
+            row = 0
+            limit = PAGE_SIZE_MAX
+            future = executor.submit(timed_fetch, row, page_size)
+            while True:
+                page, elapsed = future.result()
+                if not page:
+                    return
+                if len(page) < page_size:
+                    limit = len(page)
+                row += len(page)
+                if elapsed < PAGE_TARGET_LATENCY / 2:
+                    page_size = page_size * 2
+                elif elapsed > PAGE_TARGET_LATENCY:
+                    page_size = max(PAGE_SIZE_MIN, page_size // 2)
+                page_size = min(page_size, limit)
+
+                future = executor.submit(timed_fetch, row, page_size)
+                for item in page:
+                    if cutoff is not None and item.get(date_field, 0) < cutoff:
+                        return
+                    yield item
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def new_msg_uid():
+        return str(uuid.uuid4().int >> 65)
+
+    def send_message(self, thread_id, msg_text, msg_uid=None):
+        msg_uid = msg_uid or self.new_msg_uid()
+        files = {
+            'threadId': (None, str(thread_id)),
+            'msgText': (None, str(msg_text)),
+            'msgUID': (None, msg_uid)
+        }
+        response = self._request("POST", "/chat/sendNew", files=files)
+        return self._json(response, "/chat/sendNew")
+    
+    def get_groups_tree(self, stream=False):
+        params = {
+            "bAllTypes": "false",
+            "bApplicants": "true",
+            "bEmployees": "true",
+            "bGroups": "true"
+        }
+        if stream:
+            return self._stream_json("/groups/tree", params)
+        return self._get_json("/groups/tree", params)
+
+    def save_thread(self, interlocutor_id=None, subject=None, is_group=False, idempotent=True):
+        data = {
+            "threadId": None,
+            "senderId": None,
+            "imageId": None,
+            "subject": subject,
+            "isAllowReplay": 2,
+            "isGroup": is_group,
+            "interlocutor": interlocutor_id
+        }
+        response = self._request("PUT", "/chat/saveThread", idempotent=idempotent, json=data)
+        return self._json(response, "/chat/saveThread")
+
+    def set_members(self, thread_id, members):
+        data = [
+            {"memberId": None, "memberCode": "PRS", "memberObjId": user.prs_id, "memberObjName": user.fio}
+            for user in members
+        ]
+        response = self._request("PUT", "/chat/setMembers", params={"threadId": thread_id}, json=data)
+        if response.status_code != 200:
+            raise ESchoolAPIError(f"Ошибка запроса /chat/setMembers: HTTP {response.status_code}", response.status_code)
+
+    def get_class_by_user(self):
+        if not self.user_id:
+            self.get_state()
+        params = {"userId": self.user_id}
+        return self._get_json("/usr/getClassByUser", params)
+
+    def get_periods(self, group_id):
+        params = {"groupId": group_id}
+        return self._get_json("/dict/periods/0", params)
+
+    def get_diary_units(self, period_id):
+        if not self.user_id:
+            self.get_state()
+        params = {"userId": self.user_id, "eiId": period_id}
+        return self._get_json("/student/getDiaryUnits/", params)
+    
+    def get_diary_period(self, period_id):
+        if not self.user_id:
+            self.get_state()
+        params = {"userId": self.user_id, "eiId": period_id}
+        return self._get_json("/student/getDiaryPeriod_/", params)
+
+    def get_prs_diary(self, d1, d2, stream=False):
+        if not self.prs_id:
+            self.get_state()
+        
+        params = {
+            "prsId": self.prs_id,
+            "d1": d1,
+            "d2": d2
+        }
+        if stream:
+            return self._stream_json("/student/getPrsDiary", params, item_path=("lesson",))
+        return self._get_json("/student/getPrsDiary", params)
+
+    def get_prs_diary_window(self, d1, d2):
+        if not self.prs_id:
+            self.get_state()
+        params = {
+            "prsId": self.prs_id,
+            "d1": d1,
+            "d2": d2
+        }
+        is_past = d2 < (time.time() - PRS_DIARY_SETTLE) * 1000
+        return self._get_json("/student/getPrsDiary", params, ttl=PRS_DIARY_PAST_TTL if is_past else None)
+
+    def iter_prs_diary(self, d1, d2, window_days=PRS_DIARY_WINDOW_DAYS, workers=PRS_DIARY_WORKERS):
+        if not self.prs_id:
+            self.get_state()
+        windows = split_date_range(d1, d2, window_days)
+        if not windows:
+            return
+        with ThreadPoolExecutor(max_workers=min(workers, len(windows)), thread_name_prefix="eschool-diary") as executor:
+            futures = [executor.submit(self.get_prs_diary_window, start, end) for start, end in windows]
+            try:
+                for window, future in zip(windows, futures):
+                    yield window, future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def get_pupil_units(self, prs_id, year_id):
+        params = {
+            "prsId": prs_id,
+            "yearId": year_id
+        }
+        return self._get_json("/student/getPupilUnits", params)
+
+    def get_user_list_search(self, year_id, stream=False):
+        params = {
+            "yearId": year_id
+        }
+        if stream:
+            return self._stream_json("/usr/getUserListSearch", params)
+        return self._get_json("/usr/getUserListSearch", params)
+
+    def get_lpart_list_pupil(self, beg_date, end_date, is_odod, prs_id, year_id):
+        params = {
+            "begDate": beg_date,
+            "endDate": end_date,
+            "isOdod": is_odod,
+            "prsId": prs_id,
+            "yearId": year_id
+        }
+        return self._get_json("/student/getLPartListPupil", params)
+
+    def get_profile_new(self, prs_id):
+        params = {
+            "prsId": prs_id
+        }
+        return self._memoized(("profile_new", prs_id), lambda: self._get_json("/profile/getProfile_new", params))
+
+    def open_file(self, obj_type, obj_id, file_id, offset=0, if_range=None):
+        headers = {}
+        if offset:
+            headers['Range'] = f"bytes={offset}-"
+            if if_range:
+                headers['If-Range'] = if_range
+        return self._request("GET", f"/files/{obj_type}/{obj_id}/{file_id}", headers=headers,
+                             route=f"/files/{obj_type}", stream=True)
+
+    def current_year_id(self):
+        def load():
+            if not self.prs_id:
+                self.get_state()
+            pupils = self.get_profile_new(self.prs_id).get('pupil', [])
+            if not pupils:
+                return None
+            year_id = max(pupils, key=lambda x: x.get('bvt', '')).get('yearId')
+            return int(year_id) if str(year_id).isdigit() else None
+        return self._memoized("year_id", load)
+
+class ResponseCache:
+    INDEX_FILE = "index.json"
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.index = self._load_index()
+        self.total_bytes = sum(meta.get('size', 0) for meta in self.index.values())
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.directory, self.INDEX_FILE), 'r', encoding='utf-8') as f:
+                return OrderedDict(json.load(f))
+        except (OSError, ValueError):
+            return OrderedDict()
+
+    def _save_index(self):
+        path = os.path.join(self.directory, self.INDEX_FILE)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(list(self.index.items()), f)
+        os.replace(tmp_path, path)
+
+    def _body_path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def key(self, namespace, path, params=None):
+        raw = json.dumps([namespace, path, sorted((params or {}).items())], default=str)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            meta = self.index.get(key)
+            if meta is None:
+                return None
+            try:
+                with open(self._body_path(key), 'rb') as f:
+                    body = f.read()
+            except OSError:
+                self._drop(key)
+                return None
+            self.index.move_to_end(key)
+            return dict(meta, body=body)
+
+    def put(self, key, body, etag=None, last_modified=None):
+        with self.lock:
+            meta = self.index.pop(key, None)
+            if meta is not None:
+                self.total_bytes -= meta.get('size', 0)
+            path = self._body_path(key)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+            self.index[key] = {
+                'stored_at': time.time(),
+                'size': len(body),
+                'etag': etag,
+                'last_modified': last_modified
+            }
+            self.total_bytes += len(body)
+            self._evict()
+            self._save_index()
+
+    def touch(self, key):
+        with self.lock:
+            if key in self.index:
+                self.index[key]['stored_at'] = time.time()
+                self.index.move_to_end(key)
+                self._save_index()
+
+    def drop(self, key):
+        with self.lock:
+            self._drop(key)
+            self._save_index()
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.index):
+                self._drop(key)
+            self._save_index()
+
+    def _drop(self, key):
+        meta = self.index.pop(key, None)
+        if meta is None:
+            return
+        self.total_bytes -= meta.get('size', 0)
+        try:
+            os.remove(self._body_path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.index) > 1:
+            self._drop(next(iter(self.index)))
+
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+class AttachmentStore:
+    INDEX_FILE = "index.json"
+
+    def __init__(self, directory=DOWNLOADS_DIR):
+        self.directory = directory
+        self.objects_dir = os.path.join(directory, "objects")
+        self.partial_dir = os.path.join(directory, "partial")
+        self.lock = threading.Lock()
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.partial_dir, exist_ok=True)
+        self.index = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.directory, self.INDEX_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self):
+        path = os.path.join(self.directory, self.INDEX_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def source_key(obj_type, obj_id, file_id):
+        return f"{obj_type}/{obj_id}/{file_id}"
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def partial_path(self, source):
+        return os.path.join(self.partial_dir, hashlib.sha1(source.encode('utf-8')).hexdigest())
+
+    def lookup(self, source):
+        with self.lock:
+            meta = self.index.get(source)
+        if meta is None:
+            return None
+        path = self.object_path(meta['sha256'])
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_size != meta['size'] or st.st_mtime_ns != meta.get('mtime_ns', st.st_mtime_ns):
+            return None
+        return dict(meta, path=path)
+
+    def commit(self, source, partial, digest, size, name):
+        target = self.object_path(digest)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with self.lock:
+            if os.path.exists(target) and file_sha256(target) == digest:
+                os.remove(partial)
+            else:
+                os.replace(partial, target)
+                os.chmod(target, 0o444)
+            self.index[source] = {
+                'sha256': digest, 'size': size, 'name': name, 'stored_at': time.time(),
+                'mtime_ns': os.stat(target).st_mtime_ns
+            }
+            self._save_index()
+        return dict(self.index[source], path=target)
+
+    def export(self, digest, dest):
+        source = self.object_path(digest)
+        os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+        if os.path.exists(dest):
+            if os.path.samefile(source, dest):
+                return dest
+            os.remove(dest)
+        try:
+            os.link(source, dest)
+        except OSError:
+            shutil.copyfile(source, dest)
+        return dest
+
+class AttachmentDownloader:
+    def __init__(self, api, store=None, workers=DOWNLOAD_WORKERS):
+        self.api = api
+        self.store = store if store is not None else AttachmentStore()
+        self.workers = workers
+        self.downloaded_bytes = 0
+        self.lock = threading.Lock()
+        self._source_locks = {}
+
+    def _source_lock(self, source):
+        with self.lock:
+            return self._source_locks.setdefault(source, threading.Lock())
+
+    def fetch(self, obj_type, obj_id, file_id, name=""):
+        source = self.store.source_key(obj_type, obj_id, file_id)
+        with self._source_lock(source):
+            meta = self.store.lookup(source)
+            if meta is not None:
+                return meta
+            for attempt in range(MAX_RETRIES + 1):
+                try:
+                    return self._download(source, obj_type, obj_id, file_id, name)
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                    error = ESchoolAPIError(f"Обрыв загрузки файла {name or file_id}: {e}")
+                if attempt < MAX_RETRIES:
+                    time.sleep(self.api._backoff_delay(attempt))
+            raise error
+
+    def _download(self, source, obj_type, obj_id, file_id, name):
+        partial = self.store.partial_path(source)
+        meta_path = partial + ".json"
+        hasher = hashlib.sha256()
+        offset = 0
+        etag = None
+        if os.path.exists(partial):
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    etag = json.load(f).get('etag')
+            except (OSError, ValueError):
+                etag = None
+            with open(partial, 'rb') as f:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                    hasher.update(chunk)
+                    offset += len(chunk)
+
+        response = self.api.open_file(obj_type, obj_id, file_id, offset=offset, if_range=etag)
+        try:
+            total = None
+            if response.status_code == 206:
+                start, total = parse_content_range(response.headers.get('Content-Range'))
+                if start != offset:
+                    raise ESchoolAPIError(f"Сервер вернул не тот фрагмент файла {name or file_id}", 206)
+                mode = 'ab'
+            elif response.status_code == 200:
+                hasher = hashlib.sha256()
+                offset = 0
+                length = response.headers.get('Content-Length')
+                total = int(length) if length and length.isdigit() else None
+                mode = 'wb'
+            elif response.status_code == 416 and offset:
+                _, total = parse_content_range(response.headers.get('Content-Range'))
+                if total != offset:
+                    os.remove(partial)
+                    raise ESchoolAPIError(f"Не удалось докачать файл {name or file_id}", 416)
+                mode = None
+            else:
+                raise ESchoolAPIError(f"Не удалось скачать файл {name or file_id}: HTTP {response.status_code}", response.status_code)
+
+            if mode is not None:
+                with open(meta_path, 'w', encoding='utf-8') as f:
+                    json.dump({'etag': response.headers.get('ETag'), 'name': name}, f, ensure_ascii=False)
+                with open(partial, mode) as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        hasher.update(chunk)
+                        offset += len(chunk)
+                        with self.lock:
+                            self.downloaded_bytes += len(chunk)
+        finally:
+            response.close()
+
+        if total is not None and offset != total:
+            raise requests.exceptions.ChunkedEncodingError(f"получено {offset} из {total} байт")
+        meta = self.store.commit(source, partial, hasher.hexdigest(), offset, name)
+        try:
+            os.remove(meta_path)
+        except OSError:
+            pass
+        return meta
+
+    def fetch_many(self, items):
+        by_source = OrderedDict()
+        for item in items:
+            obj_type, obj_id, file_id, _ = item
+            by_source.setdefault(self.store.source_key(obj_type, obj_id, file_id), []).append(item)
+        if not by_source:
+            return
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(by_source)), thread_name_prefix="eschool-files") as executor:
+            futures = {executor.submit(self.fetch, *group[0]): group for group in by_source.values()}
+            for future in as_completed(futures):
+                try:
+                    meta, error = future.result(), None
+                except Exception as e:
+                    meta, error = None, e
+                for item in futures[future]:
+                    yield item, meta, error
+
+def parse_content_range(value):
+    match = CONTENT_RANGE_RE.match(value or "")
+    if match is None:
+        return None, None
+    start, total = match.group(1), match.group(2)
+    return (int(start) if start else None), (int(total) if total.isdigit() else None)
+
+@functools.lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem_word(word):
+    match = STEM_RV_RE.match(word)
+    if match is None:
+        return word
+    prefix, rv = match.groups()
+    stripped = STEM_PERFECTIVE_RE.sub('', rv, 1)
+    if stripped == rv:
+        rv = STEM_REFLEXIVE_RE.sub('', rv, 1)
+        stripped = STEM_ADJECTIVE_RE.sub('', rv, 1)
+        if stripped != rv:
+            rv = STEM_PARTICIPLE_RE.sub('', stripped, 1)
+        else:
+            stripped = STEM_VERB_RE.sub('', rv, 1)
+            rv = STEM_NOUN_RE.sub('', rv, 1) if stripped == rv else stripped
+    else:
+        rv = stripped
+    if rv.endswith('и'):
+        rv = rv[:-1]
+    if STEM_DERIVATIONAL_RE.search(rv):
+        rv = rv[:-4] if rv.endswith('ость') else rv[:-3]
+    if rv.endswith('ь'):
+        rv = rv[:-1]
+    else:
+        rv = STEM_SUPERLATIVE_RE.sub('', rv, 1)
+        if rv.endswith('нн'):
+            rv = rv[:-1]
+    return prefix + rv
+
+def search_terms(text):
+    return [stem_word(token) for token in UserDirectory.normalize(text).split() if token not in SEARCH_STOP_WORDS]
+
+class ChatStore:
+    def __init__(self, owner, path=CHAT_DB_FILE):
+        self.owner = owner or ""
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS threads (
+                owner TEXT NOT NULL,
+                thread_id INTEGER NOT NULL,
+                send_date REAL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (owner, thread_id)
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                owner TEXT NOT NULL,
+                thread_id INTEGER NOT NULL,
+                msg_num INTEGER NOT NULL,
+                create_date REAL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (owner, thread_id, msg_num)
+            );
+            CREATE INDEX IF NOT EXISTS messages_by_date ON messages (owner, thread_id, create_date);
+            CREATE TABLE IF NOT EXISTS outbox (
+                owner TEXT NOT NULL,
+                msg_uid TEXT NOT NULL,
+                thread_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                ambiguous INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                sent_at REAL,
+                PRIMARY KEY (owner, msg_uid)
+            );
+            CREATE TABLE IF NOT EXISTS interlocutors (
+                owner TEXT NOT NULL,
+                prs_id INTEGER NOT NULL,
+                thread_id INTEGER NOT NULL,
+                PRIMARY KEY (owner, prs_id)
+            );
+        """)
+        try:
+            self.conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS message_index USING fts5(body, sender, content='', tokenize='unicode61')"
+            )
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+        with self.lock, self.conn:
+            self._index_pending()
+
+    @staticmethod
+    def message_key(msg):
+        for field in ('msgNum', 'msgId'):
+            if msg.get(field) is not None:
+                return int(msg[field])
+        return int(msg.get('createDate', 0))
+
+    def upsert_threads(self, threads):
+        changed = []
+        with self.lock, self.conn:
+            for thread in threads:
+                row = self.conn.execute(
+                    "SELECT send_date FROM threads WHERE owner = ? AND thread_id = ?",
+                    (self.owner, thread['threadId'])
+                ).fetchone()
+                if row is None or row[0] != thread.get('sendDate'):
+                    changed.append(thread['threadId'])
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO threads (owner, thread_id, send_date, data) VALUES (?, ?, ?, ?)",
+                    (self.owner, thread['threadId'], thread.get('sendDate'), json.dumps(thread, ensure_ascii=False))
+                )
+        return changed
+
+    def threads(self, limit=None):
+        query = "SELECT data FROM threads WHERE owner = ? ORDER BY send_date DESC"
+        params = [self.owner]
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self.lock:
+            return [json.loads(row[0]) for row in self.conn.execute(query, params)]
+
+    def upsert_messages(self, thread_id, messages):
+        added = 0
+        with self.lock, self.conn:
+            for msg in messages:
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO messages (owner, thread_id, msg_num, create_date, data) VALUES (?, ?, ?, ?, ?)",
+                    (self.owner, thread_id, self.message_key(msg), msg.get('createDate'), json.dumps(msg, ensure_ascii=False))
+                )
+                added += cursor.rowcount
+            if added:
+                self._index_pending()
+        return added
+
+    @staticmethod
+    def message_text(msg):
+        parts = [clean_html(msg.get('msg') or '')]
+        parts.extend(attach.get('fileName') or '' for attach in msg.get('attachInfo') or [])
+        return " ".join(parts)
+
+    def _index_pending(self):
+        if not self.fts:
+            return
+        last = self.conn.execute("SELECT coalesce(max(rowid), 0) FROM message_index").fetchone()[0]
+        rows = self.conn.execute("SELECT rowid, data FROM messages WHERE rowid > ? ORDER BY rowid", (last,))
+        entries = []
+        for rowid, data in rows:
+            msg = json.loads(data)
+            entries.append((
+                rowid,
+                " ".join(search_terms(self.message_text(msg))),
+                " ".join(search_terms(msg.get('senderFio') or ''))
+            ))
+        self.conn.executemany("INSERT INTO message_index (rowid, body, sender) VALUES (?, ?, ?)", entries)
+
+    def search(self, query, limit=CHAT_SEARCH_LIMIT, thread_id=None):
+        terms = search_terms(query)
+        if not terms:
+            return []
+        if not self.fts:
+            return self._scan(terms, limit, thread_id)
+        sql = (
+            "SELECT m.thread_id, m.data, t.data FROM message_index "
+            "JOIN messages m ON m.rowid = message_index.rowid "
+            "LEFT JOIN threads t ON t.owner = m.owner AND t.thread_id = m.thread_id "
+            "WHERE message_index MATCH ? AND m.owner = ?"
+        )
+        params = [" ".join(f'"{term}"*' for term in terms), self.owner]
+        if thread_id is not None:
+            sql += " AND m.thread_id = ?"
+            params.append(thread_id)
+        sql += " ORDER BY bm25(message_index, 1.0, 0.5), m.create_date DESC LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [
+            {'thread_id': tid, 'message': json.loads(msg), 'thread': json.loads(thread) if thread else {}}
+            for tid, msg, thread in rows
+        ]
+
+    def _scan(self, terms, limit, thread_id):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT m.thread_id, m.data, t.data FROM messages m "
+                "LEFT JOIN threads t ON t.owner = m.owner AND t.thread_id = m.thread_id "
+                "WHERE m.owner = ? ORDER BY m.create_date DESC",
+                (self.owner,)
+            ).fetchall()
+        results = []
+        for tid, data, thread in rows:
+            if thread_id is not None and tid != thread_id:
+                continue
+            msg = json.loads(data)
+            words = search_terms(f"{self.message_text(msg)} {msg.get('senderFio') or ''}")
+            if all(any(word.startswith(term) for word in words) for term in terms):
+                results.append({'thread_id': tid, 'message': msg, 'thread': json.loads(thread) if thread else {}})
+                if len(results) >= limit:
+                    break
+        return results
+
+    def context(self, thread_id, create_date, before=1, after=1):
+        with self.lock:
+            older = self.conn.execute(
+                "SELECT data FROM messages WHERE owner = ? AND thread_id = ? AND create_date < ? "
+                "ORDER BY create_date DESC LIMIT ?",
+                (self.owner, thread_id, create_date, before)
+            ).fetchall()
+            newer = self.conn.execute(
+                "SELECT data FROM messages WHERE owner = ? AND thread_id = ? AND create_date > ? "
+                "ORDER BY create_date LIMIT ?",
+                (self.owner, thread_id, create_date, after)
+            ).fetchall()
+        return [json.loads(row[0]) for row in reversed(older)], [json.loads(row[0]) for row in newer]
+
+    def messages(self, thread_id, limit=None):
+        query = "SELECT data FROM messages WHERE owner = ? AND thread_id = ? ORDER BY create_date DESC, msg_num DESC"
+        params = [self.owner, thread_id]
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [json.loads(row[0]) for row in reversed(rows)]
+
+    def has_messages(self, thread_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM messages WHERE owner = ? AND thread_id = ? LIMIT 1",
+                (self.owner, thread_id)
+            ).fetchone()
+        return row is not None
+
+    def enqueue_outgoing(self, msg_uid, thread_id, text):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO outbox (owner, msg_uid, thread_id, text, created_at) VALUES (?, ?, ?, ?, ?)",
+                (self.owner, msg_uid, thread_id, text, time.time())
+            )
+
+    def _outgoing_rows(self, query, params):
+        with self.lock:
+            cursor = self.conn.execute(query, params)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def outgoing(self, thread_id=None, statuses=('pending', 'failed')):
+        query = f"SELECT * FROM outbox WHERE owner = ? AND status IN ({', '.join('?' * len(statuses))})"
+        params = [self.owner, *statuses]
+        if thread_id is not None:
+            query += " AND thread_id = ?"
+            params.append(thread_id)
+        return self._outgoing_rows(query + " ORDER BY created_at, rowid", params)
+
+    def update_outgoing(self, msg_uid, **fields):
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"UPDATE outbox SET {assignments} WHERE owner = ? AND msg_uid = ?",
+                (*fields.values(), self.owner, msg_uid)
+            )
+
+    def known_threads(self, prs_ids):
+        prs_ids = list(prs_ids)
+        found = {}
+        with self.lock:
+            for i in range(0, len(prs_ids), 500):
+                chunk = prs_ids[i:i + 500]
+                rows = self.conn.execute(
+                    f"SELECT prs_id, thread_id FROM interlocutors WHERE owner = ? AND prs_id IN ({', '.join('?' * len(chunk))})",
+                    (self.owner, *chunk)
+                )
+                found.update(rows)
+        return found
+
+    def remember_threads(self, mapping):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO interlocutors (owner, prs_id, thread_id) VALUES (?, ?, ?)",
+                [(self.owner, prs_id, thread_id) for prs_id, thread_id in mapping.items()]
+            )
+
+    def close(self):
+        self.conn.close()
+
+class ChatSync:
+    PAGE_SIZE = 25
+
+    def __init__(self, api, store):
+        self.api = api
+        self.store = store
+
+    def sync_threads(self):
+        return self.store.upsert_threads(self.api.get_threads())
+
+    def poll_new(self):
+        return self.store.upsert_threads(self.api.get_threads(new_only=True))
+
+    def sync_thread(self, thread_id):
+        known = self.store.has_messages(thread_id)
+        row_start = 0
+        added = 0
+        while True:
+            page = self.api.get_messages(thread_id, row_start=row_start, rows_count=self.PAGE_SIZE, get_new=known)
+            if not page:
+                break
+            page_added = self.store.upsert_messages(thread_id, page)
+            added += page_added
+            if not known or page_added < len(page) or len(page) < self.PAGE_SIZE:
+                break
+            row_start += len(page)
+        return added
+
+    def sync_history(self, thread_id):
+        messages = self.api.iter_messages(thread_id, page_size=self.PAGE_SIZE)
+        added = 0
+        while True:
+            chunk = list(islice(messages, CHAT_HISTORY_CHUNK))
+            if not chunk:
+                return added
+            added += self.store.upsert_messages(thread_id, chunk)
+
+    def sync_all_history(self, workers=CHAT_OPEN_WORKERS):
+        self.store.upsert_threads(list(self.api.iter_threads()))
+        thread_ids = [thread['threadId'] for thread in self.store.threads()]
+        if not thread_ids:
+            return 0
+        with ThreadPoolExecutor(max_workers=min(workers, len(thread_ids)), thread_name_prefix="eschool-history") as executor:
+            return sum(executor.map(self.sync_history, thread_ids))
+
+    @staticmethod
+    def thread_id_of(result):
+        if isinstance(result, int) or (isinstance(result, str) and result.isdigit()):
+            return int(result)
+        raise ESchoolAPIError(f"Не удалось получить ID чата. Ответ: {result}")
+
+    def open_thread(self, prs_id):
+        threads, errors = self.open_threads([prs_id])
+        if prs_id in errors:
+            raise errors[prs_id]
+        return threads[prs_id]
+
+    def open_threads(self, prs_ids, workers=CHAT_OPEN_WORKERS):
+        prs_ids = list(dict.fromkeys(prs_ids))
+        threads = self.store.known_threads(prs_ids)
+        missing = [prs_id for prs_id in prs_ids if prs_id not in threads]
+        errors = {}
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(workers, len(missing)), thread_name_prefix="eschool-open") as executor:
+                results = list(executor.map(self._save_thread, missing))
+            opened = {}
+            for prs_id, result in zip(missing, results):
+                if isinstance(result, Exception):
+                    errors[prs_id] = result
+                else:
+                    opened[prs_id] = result
+            self.store.remember_threads(opened)
+            threads.update(opened)
+        return {prs_id: threads[prs_id] for prs_id in prs_ids if prs_id in threads}, errors
+
+    def _save_thread(self, prs_id):
+        try:
+            return self.thread_id_of(self.api.save_thread(prs_id))
+        except Exception as e:
+            return e
+
+    def create_group(self, subject, members):
+        thread_id = self.thread_id_of(self.api.save_thread(subject=subject, is_group=True, idempotent=False))
+        self.api.set_members(thread_id, members)
+        return thread_id
+
+class Outbox:
+    def __init__(self, api, store, rate_limiter=None, workers=OUTBOX_WORKERS):
+        self.api = api
+        self.store = store
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter(OUTBOX_RATE)
+        self.workers = workers
+        self.listeners = []
+        self.wake = threading.Event()
+        self.flush_lock = threading.Lock()
+        self.auth_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def enqueue(self, thread_id, text):
+        msg_uid = self.api.new_msg_uid()
+        self.store.enqueue_outgoing(msg_uid, thread_id, text)
+        self.wake.set()
+        return msg_uid
+
+    def broadcast(self, thread_ids, text):
+        uids = [self.enqueue(thread_id, text) for thread_id in dict.fromkeys(thread_ids)]
+        self.wake.set()
+        return uids
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="eschool-outbox", daemon=True)
+            self.thread.start()
+        self.wake.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.wake.wait(OUTBOX_POLL_INTERVAL)
+            self.wake.clear()
+            if not self.stopped.is_set() and not self.api.offline:
+                self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            now = time.time()
+            queues = {}
+            for item in self.store.outgoing(statuses=('pending',)):
+                queues.setdefault(item['thread_id'], []).append(item)
+            queues = [items for items in queues.values() if items[0]['next_attempt_at'] <= now]
+            if not queues:
+                return []
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(queues)), thread_name_prefix="eschool-outbox-send") as executor:
+                results = [result for sent in executor.map(self._send_thread, queues) for result in sent]
+        for item, status, error in results:
+            for listener in list(self.listeners):
+                listener(item, status, error)
+        return results
+
+    def _send_thread(self, items):
+        results = []
+        for item in items:
+            status, error = self._send(item)
+            results.append((item, status, error))
+            if status != 'sent':
+                break
+        return results
+
+    def _already_delivered(self, item):
+        recent = self.api.get_messages(item['thread_id'], rows_count=OUTBOX_DEDUPE_WINDOW)
+        since = item['created_at'] * 1000 - 60 * 1000
+        return any(
+            msg.get('isOwner') and msg.get('msg') == item['text'] and (msg.get('createDate') or 0) >= since
+            for msg in recent or []
+        )
+
+    def _reauthenticate(self, session_id):
+        with self.auth_lock:
+            if self.api.session_id != session_id:
+                return True
+            try:
+                return self.api.auto_login()
+            except ESchoolAPIError:
+                return False
+
+    def _deliver(self, item):
+        if item['ambiguous'] and self._already_delivered(item):
+            return False
+        self.rate_limiter.acquire()
+        self.api.send_message(item['thread_id'], item['text'], msg_uid=item['msg_uid'])
+        return True
+
+    def _send(self, item):
+        msg_uid = item['msg_uid']
+        expired = False
+        try:
+            session_id = self.api.session_id
+            try:
+                sent_now = self._deliver(item)
+            except ESchoolAPIError as e:
+                if e.status_code not in OUTBOX_AUTH_STATUSES:
+                    raise
+                expired = not self._reauthenticate(session_id)
+                if expired:
+                    raise
+                sent_now = self._deliver(item)
+        except Exception as e:
+            attempts = item['attempts'] + 1
+            status_code = getattr(e, 'status_code', None)
+            permanent = not expired and status_code is not None and 400 <= status_code < 500 and status_code != 429
+            ambiguous = status_code is None or status_code in OUTBOX_AMBIGUOUS_STATUSES
+            if permanent or attempts >= OUTBOX_MAX_ATTEMPTS:
+                self.store.update_outgoing(msg_uid, status='failed', attempts=attempts, last_error=str(e), ambiguous=ambiguous)
+                return 'failed', e
+            delay = min(OUTBOX_RETRY_MAX, OUTBOX_RETRY_BASE * 2 ** item['attempts'])
+            self.store.update_outgoing(msg_uid, attempts=attempts, last_error=str(e), ambiguous=ambiguous,
+                                       next_attempt_at=time.time() + delay)
+            return 'pending', e
+        if not sent_now:
+            self.store.update_outgoing(msg_uid, status='sent', sent_at=time.time(), last_error=None)
+            return 'sent', None
+        self.store.update_outgoing(msg_uid, status='sent', attempts=item['attempts'] + 1, sent_at=time.time(), last_error=None)
+        return 'sent', None
+
+class ChatWatcher:
+    def __init__(self, min_interval=CHAT_WATCH_MIN_INTERVAL, focused_interval=CHAT_WATCH_FOCUSED_INTERVAL,
+                 max_interval=CHAT_WATCH_MAX_INTERVAL):
+        self.min_interval = min_interval
+        self.focused_interval = focused_interval
+        self.max_interval = max_interval
+        self.cond = threading.Condition()
+        self.accounts = {}
+        self.queue = []
+        self.seq = 0
+        self.thread = None
+
+    def _base_interval(self, state):
+        return self.focused_interval if state['focus'] is not None else self.min_interval
+
+    def _schedule(self, state, delay):
+        self.seq += 1
+        state['seq'] = self.seq
+        heapq.heappush(self.queue, (time.monotonic() + delay, self.seq, state['owner']))
+        self.cond.notify()
+
+    def watch(self, sync, listener):
+        with self.cond:
+            owner = sync.store.owner
+            state = self.accounts.get(owner)
+            if state is None or state['sync'] is not sync:
+                state = self.accounts[owner] = {
+                    'owner': owner, 'sync': sync, 'listeners': [], 'focus': None,
+                    'interval': self.min_interval, 'seq': 0
+                }
+                self._schedule(state, state['interval'])
+            state['listeners'].append(listener)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="eschool-chat-watcher", daemon=True)
+                self.thread.start()
+
+    def unwatch(self, sync, listener):
+        with self.cond:
+            state = self.accounts.get(sync.store.owner)
+            if state is None or listener not in state['listeners']:
+                return
+            state['listeners'].remove(listener)
+            if not state['listeners']:
+                del self.accounts[state['owner']]
+
+    def focus(self, sync, thread_id):
+        with self.cond:
+            state = self.accounts.get(sync.store.owner)
+            if state is None:
+                return
+            state['focus'] = thread_id
+            state['interval'] = self._base_interval(state)
+            self._schedule(state, state['interval'])
+
+    def focused(self, sync):
+        with self.cond:
+            state = self.accounts.get(sync.store.owner)
+            return state['focus'] if state is not None else None
+
+    def poke(self, sync, delay=0):
+        with self.cond:
+            state = self.accounts.get(sync.store.owner)
+            if state is not None:
+                self._schedule(state, delay)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if not self.queue:
+                        self.cond.wait()
+                        continue
+                    due, seq, owner = self.queue[0]
+                    state = self.accounts.get(owner)
+                    if state is None or state['seq'] != seq:
+                        heapq.heappop(self.queue)
+                        continue
+                    wait = due - time.monotonic()
+                    if wait > 0:
+                        self.cond.wait(wait)
+                        continue
+                    heapq.heappop(self.queue)
+                    break
+                focus = state['focus']
+            self._poll(state, seq, focus)
+
+    def _poll(self, state, seq, focus):
+        sync = state['sync']
+        new_messages = {}
+        try:
+            changed = sync.poll_new()
+            if focus is not None and focus in changed:
+                added = sync.sync_thread(focus)
+                if added:
+                    new_messages[focus] = added
+            failed = False
+        except Exception:
+            changed = []
+            failed = True
+
+        with self.cond:
+            if self.accounts.get(state['owner']) is not state:
+                return
+            base = self._base_interval(state)
+            if failed:
+                state['interval'] = min(self.max_interval, state['interval'] * 2)
+            elif changed:
+                state['interval'] = base
+            else:
+                limit = self.min_interval if state['focus'] is not None else self.max_interval
+                state['interval'] = min(limit, max(base, state['interval'] * CHAT_WATCH_BACKOFF))
+            if state['seq'] == seq:
+                self._schedule(state, state['interval'])
+            listeners = list(state['listeners'])
+
+        if changed:
+            for listener in listeners:
+                listener(changed, new_messages)
+
+class Notices:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = []
+
+    def add(self, text):
+        with self.lock:
+            self.items.append(text)
+
+    def pending(self):
+        with self.lock:
+            return bool(self.items)
+
+    def flush(self):
+        with self.lock:
+            items, self.items = self.items, []
+        for text in items:
+            console.print(text)
+
+class RateLimiter:
+    def __init__(self, rate, burst=None, min_rate=0.5):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttle(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def recover(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+class RequestMetrics:
+    CACHE_SERVED = ("hit", "revalidated", "stale")
+
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.cache = {}
+        self.retries = {}
+        self.errors = {}
+        self.screens = OrderedDict()
+        self.current_screen = None
+
+    def __call__(self, event, data):
+        handler = getattr(self, f"_on_{event}", None)
+        if handler is not None:
+            with self.lock:
+                handler(data)
+
+    def _endpoint(self, path):
+        stats = self.endpoints.get(path)
+        if stats is None:
+            stats = self.endpoints[path] = {
+                "count": 0, "errors": 0, "seconds": 0.0, "bytes": 0,
+                "decode_count": 0, "decode_seconds": 0.0, "buckets": [0] * (len(self.buckets) + 1)
+            }
+        return stats
+
+    def _screen(self):
+        name = self.current_screen or "-"
+        stats = self.screens.get(name)
+        if stats is None:
+            stats = self.screens[name] = {
+                "visits": 0, "wall_seconds": 0.0, "requests": 0, "seconds": 0.0, "bytes": 0,
+                "decode_seconds": 0.0, "cache_served": 0, "retries": 0
+            }
+        return stats
+
+    def _on_request(self, data):
+        stats = self._endpoint(data["path"])
+        stats["count"] += 1
+        if data["error"] or data["status"] >= 400:
+            stats["errors"] += 1
+        stats["seconds"] += data["duration"]
+        stats["bytes"] += data["bytes"]
+        stats["buckets"][bisect.bisect_left(self.buckets, data["duration"])] += 1
+        screen = self._screen()
+        screen["requests"] += 1
+        screen["seconds"] += data["duration"]
+        screen["bytes"] += data["bytes"]
+
+    def _on_bytes(self, data):
+        self._endpoint(data["path"])["bytes"] += data["bytes"]
+        self._screen()["bytes"] += data["bytes"]
+
+    def _on_decode(self, data):
+        stats = self._endpoint(data["path"])
+        stats["decode_count"] += 1
+        stats["decode_seconds"] += data["duration"]
+        self._screen()["decode_seconds"] += data["duration"]
+
+    def _on_retry(self, data):
+        self.retries[data["path"]] = self.retries.get(data["path"], 0) + 1
+        self._screen()["retries"] += 1
+
+    def _on_cache(self, data):
+        key = (data["path"], data["result"])
+        self.cache[key] = self.cache.get(key, 0) + 1
+        if data["result"] in self.CACHE_SERVED:
+            self._screen()["cache_served"] += 1
+
+    def _on_error(self, data):
+        self.errors[data["source"]] = self.errors.get(data["source"], 0) + 1
+
+    def _on_screen_start(self, data):
+        self.current_screen = data["name"]
+        self._screen()["visits"] += 1
+
+    def _on_screen_end(self, data):
+        self._screen()["wall_seconds"] += data["duration"]
+        self.current_screen = None
+
+    @staticmethod
+    def _labels(**labels):
+        pairs = []
+        for name, value in labels.items():
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            pairs.append(f'{name}="{value}"')
+        return "{" + ",".join(pairs) + "}"
+
+    def prometheus_text(self):
+        with self.lock:
+            endpoints = {path: dict(stats, buckets=list(stats["buckets"])) for path, stats in self.endpoints.items()}
+            cache = dict(self.cache)
+            retries = dict(self.retries)
+            errors = dict(self.errors)
+
+        lines = [
+            "# HELP eschool_request_duration_seconds Длительность HTTP-запросов к eSchool.",
+            "# TYPE eschool_request_duration_seconds histogram",
+        ]
+        for path, stats in sorted(endpoints.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), stats["buckets"]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"eschool_request_duration_seconds_bucket{self._labels(endpoint=path, le=le)} {cumulative}")
+            lines.append(f"eschool_request_duration_seconds_sum{self._labels(endpoint=path)} {stats['seconds']:.6f}")
+            lines.append(f"eschool_request_duration_seconds_count{self._labels(endpoint=path)} {stats['count']}")
+
+        counters = (
+            ("eschool_request_errors_total", "Ответы с ошибкой и сбои соединения.",
+             [(self._labels(endpoint=path), stats["errors"]) for path, stats in sorted(endpoints.items())]),
+            ("eschool_response_bytes_total", "Объем полученных данных, байты.",
+             [(self._labels(endpoint=path), stats["bytes"]) for path, stats in sorted(endpoints.items())]),
+            ("eschool_json_decode_seconds_total", "Время разбора JSON.",
+             [(self._labels(endpoint=path), f"{stats['decode_seconds']:.6f}") for path, stats in sorted(endpoints.items())]),
+            ("eschool_cache_lookups_total", "Обращения к кэшу ответов по результату.",
+             [(self._labels(endpoint=path, result=result), count) for (path, result), count in sorted(cache.items())]),
+            ("eschool_request_retries_total", "Повторные попытки запросов.",
+             [(self._labels(endpoint=path), count) for path, count in sorted(retries.items())]),
+            ("eschool_client_errors_total", "Ошибки клиента, не прервавшие работу.",
+             [(self._labels(source=source), count) for source, count in sorted(errors.items())]),
+        )
+        for name, help_text, samples in counters:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(f"{name}{labels} {value}" for labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+    def print_profile(self, out):
+        with self.lock:
+            screens = {name: dict(stats) for name, stats in self.screens.items()}
+            endpoints = {path: dict(stats) for path, stats in self.endpoints.items()}
+            errors = dict(self.errors)
+
+        table = Table(title="Профиль по экранам", box=box.ROUNDED)
+        table.add_column("Экран", style="cyan")
+        table.add_column("Визиты", justify="right")
+        table.add_column("Запросы", justify="right")
+        table.add_column("Сеть, с", justify="right")
+        table.add_column("JSON, с", justify="right")
+        table.add_column("Из кэша", justify="right")
+        table.add_column("Повторы", justify="right")
+        table.add_column("КиБ", justify="right")
+        for name, stats in screens.items():
+            table.add_row(
+                name, str(stats["visits"]), str(stats["requests"]), f"{stats['seconds']:.2f}",
+                f"{stats['decode_seconds']:.3f}", str(stats["cache_served"]), str(stats["retries"]),
+                f"{stats['bytes'] / 1024:.1f}"
+            )
+        out.print(table)
+
+        table = Table(title="Запросы по адресам", box=box.ROUNDED)
+        table.add_column("Адрес", style="cyan", overflow="fold")
+        table.add_column("Запросы", justify="right")
+        table.add_column("Ошибки", justify="right")
+        table.add_column("Среднее, мс", justify="right")
+        table.add_column("Всего, с", justify="right")
+        table.add_column("JSON, мс", justify="right")
+        table.add_column("КиБ", justify="right")
+        for path, stats in sorted(endpoints.items(), key=lambda item: -item[1]["seconds"]):
+            average = stats["seconds"] / stats["count"] * 1000 if stats["count"] else 0
+            table.add_row(
+                path, str(stats["count"]), str(stats["errors"]), f"{average:.0f}", f"{stats['seconds']:.2f}",
+                f"{stats['decode_seconds'] * 1000:.1f}", f"{stats['bytes'] / 1024:.1f}"
+            )
+        out.print(table)
+
+        if errors:
+            out.print("[yellow]Ошибки клиента: " + ", ".join(f"{source} × {count}" for source, count in errors.items()) + "[/yellow]")
+
+class SpanRecorder:
+    def __init__(self, path):
+        self.file = open(path, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+        self.trace_id = os.urandom(16).hex()
+        self.screen_span = None
+
+    def __call__(self, event, data):
+        now = time.time()
+        with self.lock:
+            if event == "screen_start":
+                self.trace_id = os.urandom(16).hex()
+                self.screen_span = os.urandom(8).hex()
+            elif event == "screen_end":
+                self._write(self.screen_span, None, f"screen {data['name']}", data["start"], now, {"eschool.screen": data["name"]}, None)
+                self.screen_span = None
+            elif event == "request":
+                attributes = {
+                    "http.request.method": data["method"],
+                    "url.path": data["path"],
+                    "eschool.attempt": data["attempt"],
+                    "eschool.response_bytes": data["bytes"],
+                }
+                if data["status"] is not None:
+                    attributes["http.response.status_code"] = data["status"]
+                error = data["error"] or (f"HTTP {data['status']}" if data["status"] >= 400 else None)
+                self._write(os.urandom(8).hex(), self.screen_span, f"{data['method']} {data['path']}",
+                            now - data["duration"], now, attributes, error)
+
+    def _write(self, span_id, parent_id, name, start, end, attributes, error):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": span_id,
+            "parentSpanId": parent_id,
+            "name": name,
+            "startTimeUnixNano": int(start * 1e9),
+            "endTimeUnixNano": int(end * 1e9),
+            "attributes": attributes,
+            "status": {"code": "ERROR", "message": error} if error else {"code": "OK"},
+        }
+        self.file.write(json.dumps(span, ensure_ascii=False) + "\n")
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class SessionPool:
+    def __init__(self, directory=SESSION_POOL_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def session_file(self, username):
+        name = hashlib.sha256(str(username).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, f"{name}.json")
+
+    @contextmanager
+    def locked(self, username):
+        with open(self.session_file(username) + ".lock", 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def client(self, username, **kwargs):
+        return ESchoolAPI(session_file=self.session_file(username), **kwargs)
+
+class AsyncESchoolAPI:
+    def __init__(self, api=None, max_connections=ESchoolAPI.POOL_SIZE):
+        self.api = api if api is not None else ESchoolAPI(pool_size=max_connections)
+        self.max_connections = max_connections
+        self.executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="eschool")
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(attr, *args, **kwargs))
+        return call
+
+    def iter_threads(self, *args, **kwargs):
+        return self._aiter(self.api.iter_threads(*args, **kwargs))
+
+    def iter_messages(self, *args, **kwargs):
+        return self._aiter(self.api.iter_messages(*args, **kwargs))
+
+    async def _aiter(self, iterator):
+        done = object()
+        pending = None
+        try:
+            while True:
+                pending = self.executor.submit(next, iterator, done)
+                item = await asyncio.wrap_future(pending)
+                pending = None
+                if item is done:
+                    return
+                yield item
+        finally:
+            if pending is not None and not pending.cancel():
+                await asyncio.wait([asyncio.wrap_future(pending)])
+            iterator.close()
+
+    async def gather(self, coros, limit=None):
+        semaphore = asyncio.Semaphore(limit or self.max_connections)
+
+        async def bounded(coro):
+            async with semaphore:
+                return await coro
+        return await asyncio.gather(*(bounded(c) for c in coros))
+
+    def run(self, *coros):
+        async def runner():
+            return await asyncio.gather(*coros)
+        results = asyncio.run(runner())
+        return results[0] if len(results) == 1 else results
+
+    def submit(self, *coros):
+        future = Future()
+
+        def worker():
+            try:
+                future.set_result(self.run(*coros))
+            except BaseException as e:
+                future.set_exception(e)
+        threading.Thread(target=worker, name="eschool-prefetch", daemon=True).start()
+        return future
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.api.session.close()
+
+def intern_str(value):
+    return sys.intern(value) if isinstance(value, str) else ""
+
+@dataclass(slots=True)
+class Thread:
+    thread_id: int
+    subject: str
+    sender_fio: str
+    preview: str
+    send_date: float
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            data['threadId'],
+            intern_str(data.get('subject')),
+            intern_str(data.get('senderFio')),
+            data.get('msgPreview') or "",
+            data.get('sendDate') or 0
+        )
+
+    @property
+    def title(self):
+        return self.subject or self.sender_fio or "Без темы"
+
+@dataclass(slots=True)
+class Message:
+    msg_id: int
+    text: str
+    sender_id: int
+    sender_fio: str
+    create_date: float
+    attachments: list
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            data.get('msgId'),
+            data.get('msg') or "",
+            data.get('senderId'),
+            intern_str(data.get('senderFio')),
+            data.get('createDate') or 0,
+            data.get('attachInfo') or []
+        )
+
+@dataclass(slots=True)
+class HomeworkFile:
+    file_id: int
+    name: str
+    variant_id: int
+
+@dataclass(slots=True)
+class Variant:
+    variant_id: int
+    text: str
+    deadline: float
+    files: list
+
+    @classmethod
+    def from_json(cls, data):
+        variant_id = data.get('id')
+        return cls(
+            variant_id,
+            data.get('text') or "",
+            data.get('deadLine'),
+            [HomeworkFile(f.get('id'), intern_str(f.get('fileName')), variant_id) for f in data.get('file') or []]
+        )
+
+@dataclass(slots=True)
+class Mark:
+    value: str
+    date: str
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(intern_str(data.get('markValue')), data.get('markDt'))
+
+@dataclass(slots=True)
+class Part:
+    cat: str
+    weight: float
+    marks: list
+    variants: list
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            intern_str(data.get('cat')),
+            data.get('mrkWt'),
+            [Mark.from_json(m) for m in data.get('mark') or []],
+            [Variant.from_json(v) for v in data.get('variant') or []]
+        )
+
+@dataclass(slots=True)
+class Lesson:
+    lesson_id: int
+    unit_id: int
+    unit_name: str
+    date: float
+    topic: str
+    parts: list
+
+    @classmethod
+    def from_json(cls, data):
+        unit = data.get('unit') or {}
+        return cls(
+            data.get('id'),
+            data.get('unitId') or unit.get('id'),
+            intern_str(unit.get('name')),
+            data.get('date') or 0,
+            data.get('subject') or "",
+            [Part.from_json(p) for p in data.get('part') or []]
+        )
+
+@dataclass(slots=True)
+class Unit:
+    unit_id: int
+    name: str
+    over_mark: float
+    total_mark: object
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data.get('unitId'), intern_str(data.get('unitName')), data.get('overMark'), data.get('totalMark'))
+
+@dataclass(slots=True)
+class Period:
+    period_id: int
+    name: str
+    date1: float
+    date2: float
+    date1_str: str
+    date2_str: str
+    group_id: int = None
+    group_name: str = ""
+    depth: int = 0
+    is_root: bool = False
+
+    @classmethod
+    def from_json(cls, data, group_id=None, group_name="", depth=0, is_root=False):
+        return cls(
+            data.get('id'),
+            intern_str(data.get('name')),
+            data.get('date1') or 0,
+            data.get('date2') or 0,
+            data.get('date1Str') or "",
+            data.get('date2Str') or "",
+            group_id,
+            group_name,
+            depth,
+            is_root
+        )
+
+    def contains(self, ts):
+        return self.date1 <= ts <= self.date2
+
+    def to_json(self):
+        return {'id': self.period_id, 'name': self.name, 'date1': self.date1, 'date2': self.date2}
+
+@dataclass(slots=True)
+class User:
+    prs_id: int
+    fio: str
+    group_name: str
+    roles: tuple
+    fingerprint: str = ""
+
+    @classmethod
+    def from_json(cls, data):
+        roles = data.get('roles')
+        if roles is None:
+            roles = [role for field, role in USER_ROLES if data.get(field) == 1]
+        return cls(
+            data.get('prsId'),
+            intern_str(data.get('fio')),
+            intern_str(data.get('groupName')),
+            tuple(sys.intern(role) for role in roles),
+            data.get('h') or ""
+        )
+
+    def to_json(self):
+        return {'prsId': self.prs_id, 'fio': self.fio, 'groupName': self.group_name, 'roles': list(self.roles), 'h': self.fingerprint}
+
+@dataclass(slots=True)
+class Group:
+    group_id: int
+    group_name: str
+    beg_date: float
+
+    @classmethod
+    def from_json(cls, data):
+        group_id = data['groupId']
+        return cls(group_id, intern_str(data.get('groupName')) or f"Group {group_id}", data.get('begDate') or 0)
+
+def collect_marks(lessons):
+    marks = {}
+    for lesson in lessons:
+        for part in lesson.parts:
+            weight = float(part.weight or 1.0)
+            for mark in part.marks:
+                value = parse_mark_value(mark.value)
+                if value is not None:
+                    marks.setdefault(lesson.unit_id or 0, []).append(
+                        (parse_mark_date(mark.date, lesson.date), value, weight, part.cat)
+                    )
+    for unit_marks in marks.values():
+        unit_marks.sort(key=lambda mark: mark[0])
+    return marks
+
+def weighted_average(marks):
+    total_weight = sum(weight for _, _, weight, _ in marks)
+    if not total_weight:
+        return None
+    return round(sum(value * weight for _, value, weight, _ in marks) / total_weight, 2)
+
+def averages_by_type(marks):
+    groups = {}
+    for mark in marks:
+        groups.setdefault(mark[3], []).append(mark)
+    return {mark_type: (weighted_average(group), len(group)) for mark_type, group in groups.items()}
+
+def moving_average(marks, window=MOVING_AVERAGE_WINDOW):
+    result = []
+    sum_vw = sum_w = 0.0
+    for pos, (_, value, weight, _) in enumerate(marks):
+        sum_vw += value * weight
+        sum_w += weight
+        if pos >= window:
+            _, old_value, old_weight, _ = marks[pos - window]
+            sum_vw -= old_value * old_weight
+            sum_w -= old_weight
+        result.append(round(sum_vw / sum_w, 2) if sum_w else None)
+    return result
+
+def period_averages(marks_by_period):
+    trends = {}
+    for period_id, unit_marks in marks_by_period:
+        for unit_id, marks in unit_marks.items():
+            average = weighted_average(marks)
+            if average is not None:
+                trends.setdefault(unit_id, {})[period_id] = average
+    return trends
+
+def needed_marks(marks, target, mark=5.0, weight=1.0, limit=100):
+    sum_vw = sum(value * w for _, value, w, _ in marks)
+    sum_w = sum(w for _, _, w, _ in marks)
+    if sum_w and sum_vw / sum_w >= target:
+        return 0
+    if mark <= target:
+        return None
+    needed = math.ceil((target * sum_w - sum_vw) / (weight * (mark - target)) - 1e-9)
+    return needed if needed <= limit else None
+
+def marks_slope(marks):
+    n = len(marks)
+    if n < 2:
+        return 0.0
+    days = [date / 86400000 for date, _, _, _ in marks]
+    mean_x = sum(days) / n
+    mean_y = sum(value for _, value, _, _ in marks) / n
+    var_x = sum((x - mean_x) ** 2 for x in days)
+    if not var_x:
+        return 0.0
+    return sum((x - mean_x) * (value - mean_y) for x, (_, value, _, _) in zip(days, marks)) / var_x
+
+def iter_json_items(chunks, path=()):
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    state = {'buf': "", 'pos': 0, 'eof': False}
+
+    def fill():
+        if state['eof']:
+            return False
+        chunk = next(chunks, None)
+        if chunk is None:
+            state['eof'] = True
+            state['buf'] = state['buf'][state['pos']:] + text.decode(b"", final=True)
+        else:
+            state['buf'] = state['buf'][state['pos']:] + text.decode(chunk)
+        state['pos'] = 0
+        return True
+
+    def drain():
+        if not state['eof']:
+            parts = [state['buf'][state['pos']:]]
+            parts.extend(text.decode(chunk) for chunk in chunks)
+            parts.append(text.decode(b"", final=True))
+            state.update(buf="".join(parts), pos=0, eof=True)
+
+    def peek():
+        while True:
+            buf, pos = state['buf'], state['pos']
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            state['pos'] = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not fill():
+                raise ValueError("Неожиданный конец JSON")
+
+    def expect(char):
+        if peek() != char:
+            raise ValueError(f"Ожидался символ {char!r} в JSON")
+        state['pos'] += 1
+
+    def value():
+        peek()
+        attempted = 0
+        while True:
+            buf, pos = state['buf'], state['pos']
+            if state['eof'] or len(buf) - pos >= 2 * attempted:
+                try:
+                    obj, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if state['eof']:
+                        raise
+                    attempted = len(buf) - pos
+                else:
+                    if state['eof'] or (end < len(buf) and buf[end] not in JSON_NUMBER_CHARS):
+                        state['pos'] = end
+                        return obj
+                    attempted = 0
+            fill()
+
+    for key in path:
+        if peek() != '{':
+            return
+        expect('{')
+        while True:
+            if peek() == '}':
+                return
+            name = value()
+            expect(':')
+            if name == key:
+                break
+            value()
+            if peek() == ',':
+                expect(',')
+
+    if peek() != '[':
+        drain()
+        obj = value()
+        if isinstance(obj, dict):
+            yield obj
+        return
+    expect('[')
+    if peek() == ']':
+        return
+    while True:
+        yield value()
+        if peek() == ']':
+            return
+        expect(',')
+
+def split_date_range(d1, d2, window_days):
+    step = window_days * 86400000
+    windows = []
+    start = int(d1)
+    while start <= d2:
+        end = min(start + step - 1, int(d2))
+        windows.append((start, end))
+        start = end + 1
+    return windows
+
+def parse_mark_value(raw):
+    if raw is None:
+        return None
+    match = MARK_VALUE_RE.match(str(raw).strip())
+    return float(match.group(0).replace(',', '.')) if match else None
+
+def parse_mark_date(raw, fallback=0):
+    if raw:
+        try:
+            return datetime.fromisoformat(str(raw)).timestamp() * 1000
+        except ValueError:
+            pass
+    return float(fallback) if isinstance(fallback, (int, float)) else 0.0
+
+class UserDirectory:
+    def __init__(self, year_id, directory=DIRECTORY_DIR):
+        self.year_id = year_id
+        self.path = os.path.join(directory, f"{year_id}.json")
+        self.directory = directory
+        self.users = {}
+        self.updated_at = 0
+        self.trigrams = {}
+        self.tokens = []
+        self.token_docs = {}
+        self.facets = {}
+
+    @staticmethod
+    def normalize(text):
+        text = str(text or '').lower().replace('ё', 'е')
+        return " ".join(DIRECTORY_NON_WORD_RE.sub(" ", text).split())
+
+    @staticmethod
+    def grams(token):
+        padded = f" {token} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        self.updated_at = data.get('updated_at', 0)
+        for user in data.get('users', []):
+            self._add(User.from_json(user))
+        self._rebuild_tokens()
+        return True
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'updated_at': self.updated_at, 'users': [u.to_json() for u in self.users.values()]}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def update(self, users):
+        seen = set()
+        changed = 0
+        for raw in users:
+            user = self._record(raw)
+            if user is None:
+                continue
+            seen.add(user.prs_id)
+            current = self.users.get(user.prs_id)
+            if current is not None and current.fingerprint == user.fingerprint:
+                continue
+            if current is not None:
+                self._remove(current)
+            self._add(user)
+            changed += 1
+        if not seen:
+            raise ESchoolAPIError("Сервер вернул пустой или некорректный список пользователей")
+        for prs_id in [p for p in self.users if p not in seen]:
+            self._remove(self.users[prs_id])
+            changed += 1
+        if changed:
+            self._rebuild_tokens()
+        self.updated_at = time.time()
+        return changed
+
+    def _record(self, raw):
+        if not isinstance(raw, dict) or raw.get('prsId') is None:
+            return None
+        user = User.from_json(raw)
+        user.fingerprint = hashlib.md5(json.dumps(user.to_json(), sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()[:12]
+        return user
+
+    def _facet_keys(self, user):
+        keys = [('role', role) for role in user.roles]
+        if user.group_name:
+            keys.append(('group', self.normalize(user.group_name)))
+        return keys
+
+    def _add(self, user):
+        prs_id = user.prs_id
+        self.users[prs_id] = user
+        for token in self.normalize(user.fio).split():
+            docs = self.token_docs.get(token)
+            if docs is None:
+                docs = self.token_docs[token] = set()
+                for gram in self.grams(token):
+                    self.trigrams.setdefault(gram, set()).add(token)
+            docs.add(prs_id)
+        for key in self._facet_keys(user):
+            self.facets.setdefault(key, set()).add(prs_id)
+
+    def _remove(self, user):
+        prs_id = user.prs_id
+        self.users.pop(prs_id, None)
+        for token in self.normalize(user.fio).split():
+            docs = self.token_docs.get(token)
+            if docs is None:
+                continue
+            docs.discard(prs_id)
+            if docs:
+                continue
+            del self.token_docs[token]
+            for gram in self.grams(token):
+                tokens = self.trigrams.get(gram)
+                if tokens is not None:
+                    tokens.discard(token)
+                    if not tokens:
+                        del self.trigrams[gram]
+        for key in self._facet_keys(user):
+            docs = self.facets.get(key)
+            if docs is not None:
+                docs.discard(prs_id)
+
+    def _rebuild_tokens(self):
+        self.tokens = sorted(self.token_docs)
+
+    def _match_tokens(self, query_token):
+        matches = {}
+        i = bisect.bisect_left(self.tokens, query_token)
+        while i < len(self.tokens) and self.tokens[i].startswith(query_token):
+            matches[self.tokens[i]] = 2.0
+            i += 1
+        if len(query_token) >= 3:
+            grams = self.grams(query_token)
+            hits = {}
+            for gram in grams:
+                for token in self.trigrams.get(gram, ()):
+                    hits[token] = hits.get(token, 0) + 1
+            threshold = max(1, len(grams) // 2)
+            for token, count in hits.items():
+                if count >= threshold and token not in matches:
+                    matches[token] = count / len(grams)
+        return matches
+
+    def count(self, role=None, group=None):
+        return len(self._facet_filter(role, group) if role or group else self.users)
+
+    def _facet_filter(self, role=None, group=None):
+        docs = None
+        if role:
+            docs = set(self.facets.get(('role', role), ()))
+        if group:
+            group_docs = self.facets.get(('group', self.normalize(group)), set())
+            docs = set(group_docs) if docs is None else docs & group_docs
+        return docs
+
+    def search(self, query, role=None, group=None, limit=20):
+        allowed = self._facet_filter(role, group)
+        scores = None
+        for query_token in self.normalize(query).split():
+            token_scores = {}
+            for token, score in self._match_tokens(query_token).items():
+                for prs_id in self.token_docs[token]:
+                    if score > token_scores.get(prs_id, 0):
+                        token_scores[prs_id] = score
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {prs_id: score + token_scores[prs_id] for prs_id, score in scores.items() if prs_id in token_scores}
+            if not scores:
+                break
+        if scores is None:
+            scores = dict.fromkeys(allowed if allowed is not None else self.users, 0)
+        if allowed is not None:
+            scores = {prs_id: score for prs_id, score in scores.items() if prs_id in allowed}
+        ranked = heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], self.users[item[0]].fio))
+        return [self.users[prs_id] for prs_id, _ in ranked]
+
+def load_user_directory(client, year_id, max_age=DIRECTORY_MAX_AGE):
+    directory = UserDirectory(year_id)
+    directory.load()
+    if client.offline or time.time() - directory.updated_at < max_age:
+        return directory
+    try:
+        directory.update(client.get_user_list_search(year_id, stream=True))
+    except ESchoolAPIError:
+        if not directory.users:
+            raise
+        return directory
+    directory.save()
+    return directory
+
+class SchoolTree:
+    ROOT, ORG, CATEGORY, GROUP, USER = range(5)
+    KIND_LABELS = {ORG: "🏢 Орг.", CATEGORY: "📂 Кат.", GROUP: "👥 Группа", USER: "👤 Польз."}
+
+    __slots__ = ('parent', 'kind', 'first_child', 'child_count', 'user_count', 'ids',
+                 'names', 'positions', 'by_id', 'index_tokens')
+
+    def __init__(self, tree_data):
+        self.parent = array('l')
+        self.kind = array('b')
+        self.first_child = array('l')
+        self.child_count = array('l')
+        self.user_count = array('l')
+        self.ids = array('q')
+        self.names = []
+        self.positions = []
+        self.by_id = {}
+
+        payloads = [tree_data]
+        self._append(-1, self.ROOT, 0, "Справочник школы", "")
+        i = 0
+        while i < len(payloads):
+            children = self._children_of(payloads[i])
+            payloads[i] = None
+            self.first_child[i] = len(payloads)
+            self.child_count[i] = len(children)
+            for child in children:
+                kind, node_id, name, position = self._describe(child)
+                node = self._append(i, kind, node_id, name, position)
+                self.by_id.setdefault((kind, node_id), node)
+                payloads.append(child)
+            i += 1
+
+        for node in range(len(self.kind) - 1, -1, -1):
+            if self.kind[node] == self.USER:
+                self.user_count[node] += 1
+            if self.parent[node] >= 0:
+                self.user_count[self.parent[node]] += self.user_count[node]
+
+        tokens = []
+        for node in range(1, len(self.kind)):
+            text = UserDirectory.normalize(f"{self.names[node]} {self.positions[node]}")
+            tokens.extend((token, node) for token in set(text.split()))
+        tokens.sort()
+        self.index_tokens = tokens
 
-    def send_message(self, thread_id, msg_text):
-        url = f"{self.BASE_URL}/chat/sendNew"
-        msg_uid = str(int(time.time() * 1000))
-        files = {
-            'threadId': (None, str(thread_id)),
-            'msgText': (None, str(msg_text)),
-            'msgUID': (None, msg_uid)
-        }
-        response = self.session.post(url, files=files, headers=self._get_headers())
-        return response.json()
-    
-    def get_groups_tree(self):
-        url = f"{self.BASE_URL}/groups/tree"
-        params = {
-            "bAllTypes": "false",
-            "bApplicants": "true",
-            "bEmployees": "true",
-            "bGroups": "true"
-        }
-        response = self.session.get(url, params=params, headers=self._get_headers())
-        return response.json()
+    def _append(self, parent, kind, node_id, name, position):
+        self.parent.append(parent)
+        self.kind.append(kind)
+        self.first_child.append(0)
+        self.child_count.append(0)
+        self.user_count.append(0)
+        self.ids.append(node_id or 0)
+        self.names.append(sys.intern(name))
+        self.positions.append(sys.intern(position))
+        return len(self.kind) - 1
 
-    def save_thread(self, interlocutor_id):
-        url = f"{self.BASE_URL}/chat/saveThread"
-        data = {
-            "threadId": None,
-            "senderId": None,
-            "imageId": None,
-            "subject": None,
-            "isAllowReplay": 2,
-            "isGroup": False,
-            "interlocutor": interlocutor_id
-        }
-        response = self.session.put(url, json=data, headers=self._get_headers())
-        return response.json()
+    @staticmethod
+    def _children_of(item):
+        if isinstance(item, list):
+            return item
+        if isinstance(item, dict):
+            return (item.get('groups') or []) + (item.get('users') or [])
+        return []
 
-    def get_class_by_user(self):
-        if not self.user_id:
-            self.get_state()
-        url = f"{self.BASE_URL}/usr/getClassByUser"
-        params = {"userId": self.user_id}
-        response = self.session.get(url, params=params, headers=self._get_headers())
-        return response.json()
+    def _describe(self, item):
+        if 'orgName' in item:
+            return self.ORG, item.get('orgId'), item['orgName'] or "", ""
+        if 'groupTypeName' in item and 'groupName' not in item:
+            return self.CATEGORY, item.get('groupTypeId'), item['groupTypeName'] or "", ""
+        if 'groupName' in item:
+            return self.GROUP, item.get('groupId'), item['groupName'] or "", ""
+        if 'fio' in item:
+            positions = ", ".join(filter(None, (p.get('posTypeName', '') for p in item.get('pos') or [])))
+            return self.USER, item.get('prsId'), item['fio'] or "", positions
+        return self.CATEGORY, None, "", ""
 
-    def get_periods(self, group_id):
-        url = f"{self.BASE_URL}/dict/periods/0"
-        params = {"groupId": group_id}
-        response = self.session.get(url, params=params, headers=self._get_headers())
-        return response.json()
+    def __len__(self):
+        return len(self.kind)
 
-    def get_diary_units(self, period_id):
-        if not self.user_id:
-            self.get_state()
-        url = f"{self.BASE_URL}/student/getDiaryUnits/"
-        params = {"userId": self.user_id, "eiId": period_id}
-        response = self.session.get(url, params=params, headers=self._get_headers())
-        return response.json()
-    
-    def get_diary_period(self, period_id):
-        if not self.user_id:
-            self.get_state()
-        url = f"{self.BASE_URL}/student/getDiaryPeriod_/" 
-        params = {"userId": self.user_id, "eiId": period_id}
-        response = self.session.get(url, params=params, headers=self._get_headers())
-        return response.json()
+    def children(self, node):
+        start = self.first_child[node]
+        return range(start, start + self.child_count[node])
 
-    def get_prs_diary(self, d1, d2):
-        if not self.prs_id:
-            self.get_state()
-        
-        url = f"{self.BASE_URL}/student/getPrsDiary"
-        params = {
-            "prsId": self.prs_id,
-            "d1": d1,
-            "d2": d2
-        }
-        response = self.session.get(url, params=params, headers=self._get_headers())
-        return response.json()
+    def path(self, node):
+        nodes = []
+        while node > 0:
+            nodes.append(node)
+            node = self.parent[node]
+        return nodes[::-1]
 
-    def get_pupil_units(self, prs_id, year_id):
-        url = f"{self.BASE_URL}/student/getPupilUnits"
-        params = {
-            "prsId": prs_id,
-            "yearId": year_id
-        }
-        response = self.session.get(url, params=params, headers=self._get_headers())
-        return response.json()
+    def find(self, kind, node_id):
+        return self.by_id.get((kind, node_id))
 
-    def get_user_list_search(self, year_id):
-        url = f"{self.BASE_URL}/usr/getUserListSearch"
-        params = {
-            "yearId": year_id
-        }
-        response = self.session.get(url, params=params, headers=self._get_headers())
-        return response.json()
+    def user(self, node):
+        return User(self.ids[node], self.names[node], "", ())
 
-    def get_lpart_list_pupil(self, beg_date, end_date, is_odod, prs_id, year_id):
-        url = f"{self.BASE_URL}/student/getLPartListPupil"
-        params = {
-            "begDate": beg_date,
-            "endDate": end_date,
-            "isOdod": is_odod,
-            "prsId": prs_id,
-            "yearId": year_id
-        }
-        response = self.session.get(url, params=params, headers=self._get_headers())
-        return response.json()
+    def members(self, node):
+        users = {}
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if self.kind[current] == self.USER:
+                users.setdefault(self.ids[current], current)
+            else:
+                stack.extend(reversed(self.children(current)))
+        return [self.user(n) for n in sorted(users.values(), key=lambda n: (self.names[n], n))]
 
-    def get_profile_new(self, prs_id):
-        url = f"{self.BASE_URL}/profile/getProfile_new"
-        params = {
-            "prsId": prs_id
-        }
-        response = self.session.get(url, params=params, headers=self._get_headers())
-        return response.json()
+    def search(self, query, kind=None, limit=50):
+        matches = None
+        for query_token in UserDirectory.normalize(query).split():
+            found = set()
+            i = bisect.bisect_left(self.index_tokens, (query_token, -1))
+            while i < len(self.index_tokens) and self.index_tokens[i][0].startswith(query_token):
+                found.add(self.index_tokens[i][1])
+                i += 1
+            matches = found if matches is None else matches & found
+            if not matches:
+                return []
+        if matches is None:
+            return []
+
+        results = []
+        seen_users = set()
+        for node in sorted(matches, key=lambda n: (self.names[n], n)):
+            if kind is not None and self.kind[node] != kind:
+                continue
+            if self.kind[node] == self.USER:
+                if self.ids[node] in seen_users:
+                    continue
+                seen_users.add(self.ids[node])
+            results.append(node)
+            if len(results) >= limit:
+                break
+        return results
+
+PERIODS_CONCURRENCY = 6
 
-console = Console()
-api = ESchoolAPI()
+console = LazyObject(Console)
+api = LazyObject(ESchoolAPI)
+aapi = LazyObject(lambda: AsyncESchoolAPI(api))
+chat_sync = None
+chat_watcher = ChatWatcher()
+notices = Notices()
+outbox = None
 
 def clear_screen():
     console.clear()
@@ -310,14 +2798,106 @@ def print_header(title="eSchool CLI"):
     grid.add_row(Panel(Text(title, justify="center", style="bold cyan"), style="cyan", box=box.HEAVY))
     console.print(grid)
 
+class HtmlTokens(dict):
+    def __init__(self):
+        super().__init__(HTML_TAG_TEXT)
+        self.update({'ul': '', 'li': '\n• ', '/li': ''})
+        self.limit = len(self) + HTML_TOKEN_CACHE_SIZE
+
+    def __missing__(self, token):
+        match = HTML_TAG_TOKEN_RE.fullmatch(token)
+        if match is None or match[2].lower() in HTML_STATEFUL_TAGS:
+            raise ValueError(token)
+        text = HTML_TAG_TEXT.get(match[1] + match[2].lower(), '')
+        if len(self) < self.limit:
+            self[token] = text
+        return text
+
+@functools.lru_cache(maxsize=None)
+def html_tokens():
+    return HtmlTokens()
+
+def html_text_fast(text):
+    pieces = text.replace('>', '<').split('<')
+    if len(pieces) != 2 * text.count('<') + 1:
+        return None
+    tokens = pieces[1::2]
+    if text.find('>') < text.find('<') or tokens.count('ul') > 1:
+        return None
+    try:
+        pieces[1::2] = map(html_tokens().__getitem__, tokens)
+    except ValueError:
+        return None
+    return ''.join(pieces)
+
+def html_text_slow(text):
+    if '<' in text:
+        if '<!' in text or '<?' in text or '<s' in text or '<S' in text:
+            text = HTML_SKIP_RE.sub('', text)
+        pieces = HTML_TAG_RE.split(text)
+        lists = []
+        for i in range(1, len(pieces), 3):
+            closing = pieces[i]
+            tag = pieces[i + 1].lower()
+            pieces[i + 1] = ''
+            if tag == 'li':
+                out = ''
+                if not closing:
+                    if lists and lists[-1] is not None:
+                        lists[-1] += 1
+                        bullet = f"{lists[-1]}. "
+                    else:
+                        bullet = "• "
+                    out = '\n' + HTML_INDENT * max(0, len(lists) - 1) + bullet
+            elif tag == 'ul' or tag == 'ol':
+                out = ''
+                if not closing:
+                    lists.append(0 if tag == 'ol' else None)
+                else:
+                    if lists:
+                        lists.pop()
+                    out = '\n'
+            else:
+                out = HTML_TAG_TEXT.get(closing + tag, '')
+            pieces[i] = out
+        text = ''.join(pieces)
+    return text
+
+def html_unescape(text):
+    for entity, char in HTML_COMMON_ENTITIES:
+        if entity in text:
+            text = text.replace(entity, char)
+            if '&' not in text:
+                return text
+    return html.unescape(text)
+
+@functools.lru_cache(maxsize=HTML_CACHE_SIZE)
 def clean_html(raw_html):
     if not raw_html:
         return ""
-    cleanr = re.compile('<.*?>')
-    text = raw_html.replace('<br>', '\n').replace('</p>', '\n').replace('<p>', '')
-    text = re.sub(cleanr, '', text)
+    if HTML_INDENT in raw_html:
+        raw_html = raw_html.replace(HTML_INDENT, '')
+    if '<' not in raw_html and '&' not in raw_html:
+        return raw_html.strip()
+
+    text = html_text_fast(raw_html)
+    if text is None:
+        text = html_text_slow(raw_html)
+    if '&' in text:
+        text = html_unescape(text)
+    if '\n\n\n' in text:
+        text = HTML_BLANK_LINES_RE.sub('\n\n', text)
+    if HTML_INDENT in text:
+        text = text.replace(HTML_INDENT, '  ')
     return text.strip()
 
+def lookup_year_id():
+    try:
+        return api.current_year_id()
+    except Exception as e:
+        console.print(f"[yellow]Не удалось определить учебный год автоматически: {e}[/yellow]")
+        return None
+
 def login_screen():
     if os.path.exists(ESchoolAPI.SESSION_FILE):
         with console.status("[bold blue]Вход по сохраненным данным...[/bold blue]", spinner="dots"):
@@ -325,15 +2905,18 @@ def login_screen():
                 if api.auto_login():
                     api.get_state()
                     console.print("[bold green]Автоматический вход выполнен![/bold green]")
-                    time.sleep(1)
                     return True
                 else:
                     console.print("[yellow]Сохраненная сессия устарела.[/yellow]")
             except Exception as e:
                  console.print(f"[red]Ошибка авто-входа: {e}[/red]")
-            time.sleep(1)
+    else:
+        clear_screen()
+
+    if api.offline:
+        console.print("[red]Офлайн-режим недоступен: нет сохраненных данных для входа.[/red]")
+        return False
 
-    clear_screen()
     print_header("Вход в систему")
     console.print("[yellow]Введите данные для входа в eSchool[/yellow]\n")
     username = Prompt.ask("[bold green]Логин[/bold green]")
@@ -345,15 +2928,12 @@ def login_screen():
             if success:
                 api.get_state() 
                 console.print("[bold green]Успешный вход![/bold green]")
-                time.sleep(1)
                 return True
             else:
                 console.print("[bold red]Не удалось войти.[/bold red]")
-                time.sleep(2)
                 return False
         except Exception as e:
             console.print(f"[bold red]Ошибка: {e}[/bold red]")
-            time.sleep(3)
             return False
 
 def show_profile():
@@ -376,12 +2956,66 @@ def show_profile():
         console.print(f"[red]Ошибка загрузки профиля: {e}[/red]")
     Prompt.ask("\nНажмите Enter, чтобы вернуться назад")
 
+def get_chat_sync():
+    global chat_sync
+    if chat_sync is None or chat_sync.store.owner != (api.username or ""):
+        chat_sync = ChatSync(api, ChatStore(api.username))
+    return chat_sync
+
+def get_outbox():
+    global outbox
+    sync = get_chat_sync()
+    if outbox is None or outbox.store is not sync.store:
+        if outbox is not None:
+            outbox.stop()
+        outbox = Outbox(api, sync.store)
+        outbox.listeners.append(report_outgoing)
+        outbox.start()
+    return outbox
+
+def report_outgoing(item, status, error):
+    text = item['text'] if len(item['text']) <= 40 else item['text'][:40] + "..."
+    if status == 'sent':
+        sync = get_chat_sync()
+        try:
+            sync.sync_thread(item['thread_id'])
+        except Exception:
+            pass
+        chat_watcher.poke(sync)
+        notices.add(f"[green]✓ Отправлено: {text}[/green]")
+    elif status == 'failed':
+        notices.add(f"[red]✗ Не удалось отправить «{text}»: {error}[/red]")
+    else:
+        notices.add(f"[yellow]Сообщение «{text}» пока не отправлено ({error}), повторим автоматически[/yellow]")
+
 def show_chats():
+    sync = get_chat_sync()
+
+    def notify(changed, new_messages):
+        focused = chat_watcher.focused(sync)
+        titles = [Thread.from_json(t).title for t in sync.store.threads() if t['threadId'] in changed and t['threadId'] != focused]
+        if titles:
+            notices.add(f"\n[bold magenta]🔔 Новые сообщения: {', '.join(titles)}[/bold magenta] [dim](Enter - обновить список)[/dim]")
+
+    chat_watcher.watch(sync, notify)
+    try:
+        chat_list_loop(sync)
+    finally:
+        chat_watcher.unwatch(sync, notify)
+
+def chat_list_loop(sync):
+    refresh = True
     while True:
         clear_screen()
         print_header("Сообщения")
         with console.status("Загрузка чатов...", spinner="dots"):
-            threads = api.get_threads()
+            if refresh:
+                try:
+                    sync.sync_threads()
+                except Exception as e:
+                    console.print(f"[yellow]Не удалось обновить чаты: {e}[/yellow]")
+                refresh = False
+            threads = [Thread.from_json(t) for t in sync.store.threads(limit=20)]
         
         table = Table(title="Ваши диалоги", box=box.SIMPLE_HEAD, show_lines=True)
         table.add_column("#", justify="right", style="cyan", no_wrap=True)
@@ -391,51 +3025,174 @@ def show_chats():
         
         thread_map = {}
         for idx, thread in enumerate(threads, 1):
-            thread_map[idx] = thread['threadId']
-            subject = thread.get('subject') or thread.get('senderFio') or "Без темы"
-            preview = thread.get('msgPreview', '')[:50] + "..." if len(thread.get('msgPreview', '')) > 50 else thread.get('msgPreview', '')
-            date_str = datetime.fromtimestamp(thread['sendDate'] / 1000).strftime('%d.%m %H:%M')
-            table.add_row(str(idx), subject, preview, date_str)
+            thread_map[idx] = thread.thread_id
+            preview = thread.preview[:50] + "..." if len(thread.preview) > 50 else thread.preview
+            date_str = datetime.fromtimestamp(thread.send_date / 1000).strftime('%d.%m %H:%M')
+            table.add_row(str(idx), thread.title, preview, date_str)
             
         console.print(table)
-        console.print("\n[dim]Введите номер чата, 'u' обновить, '0' выход[/dim]")
-        choice = Prompt.ask("Выбор")
+        notices.flush()
+        console.print("\n[dim]Введите номер чата, 's' поиск, 'b' рассылка, 'u' обновить, '0' выход. Новые сообщения проверяются автоматически.[/dim]")
+        choice = Prompt.ask("Выбор", default="")
         
         if choice == '0': break
-        elif choice.lower() == 'u': continue
+        elif choice.lower() == 'u': refresh = True
+        elif choice.lower() == 'b': broadcast_message(thread_map)
+        elif choice.lower() == 's': search_chats(sync)
         elif choice.isdigit() and int(choice) in thread_map:
             view_thread(thread_map[int(choice)])
 
-def view_thread(thread_id):
+def search_chats(sync):
     while True:
         clear_screen()
-        with console.status("Загрузка сообщений...", spinner="dots"):
-            messages = api.get_messages(thread_id)
-            messages.reverse() 
-        print_header("Чат")
-        for msg in messages:
-            sender = msg.get('senderFio', 'Неизвестный')
-            text = msg.get('msg', '')
-            date = datetime.fromtimestamp(msg['createDate'] / 1000).strftime('%H:%M')
-            is_me = False
-            if api.profile_data:
-                 my_fio = f"{api.profile_data.get('lastName')} {api.profile_data.get('firstName')} {api.profile_data.get('middleName')}"
-                 is_me = sender == my_fio
-            color = "green" if is_me else "yellow"
-            align = "right" if is_me else "left"
-            msg_panel = Panel(f"{text}\n[dim]{date}[/dim]", title=f"[bold {color}]{sender}[/bold {color}]", title_align=align, border_style=color, width=60, expand=False)
-            console.print(msg_panel, justify="right" if is_me else "left")
-                
-        console.print("\n[dim]'r' - ответить, 'u' - обновить, '0' - назад[/dim]")
-        choice = Prompt.ask("Действие")
+        print_header("Поиск по сообщениям")
+        console.print("[dim]Поиск идет по сохраненной истории. 'h' загрузить всю историю чатов, Enter - назад[/dim]")
+        query = Prompt.ask("Запрос", default="").strip()
+        if not query:
+            return
+        if query.lower() == 'h':
+            with console.status("Загрузка истории чатов...", spinner="dots"):
+                try:
+                    added = sync.sync_all_history()
+                    console.print(f"[green]Сохранено новых сообщений: {added}[/green]")
+                except Exception as e:
+                    console.print(f"[red]Ошибка загрузки истории: {e}[/red]")
+            Prompt.ask("Нажмите Enter", default="")
+            continue
+
+        start = time.perf_counter()
+        results = sync.store.search(query)
+        elapsed = (time.perf_counter() - start) * 1000
+        if not results:
+            console.print("[yellow]Ничего не найдено[/yellow]")
+            Prompt.ask("Нажмите Enter", default="")
+            continue
+
+        terms = search_terms(query)
+        result_map = {}
+        for idx, result in enumerate(results, 1):
+            result_map[idx] = result['thread_id']
+            msg = Message.from_json(result['message'])
+            thread = result['thread']
+            title = thread.get('subject') or thread.get('senderFio') or f"Чат {result['thread_id']}"
+            date_str = datetime.fromtimestamp(msg.create_date / 1000).strftime('%d.%m.%Y %H:%M') if msg.create_date else ""
+            older, newer = sync.store.context(result['thread_id'], msg.create_date)
+            body = Text()
+            for other in older:
+                body.append(f"{other.get('senderFio') or ''}: {clean_html(other.get('msg') or '')[:80]}\n", style="dim")
+            body.append(f"{msg.sender_fio}: ", style="bold")
+            body.append_text(highlight_terms(clean_html(msg.text), terms))
+            for other in newer:
+                body.append(f"\n{other.get('senderFio') or ''}: {clean_html(other.get('msg') or '')[:80]}", style="dim")
+            console.print(Panel(body, title=f"[cyan]{idx}.[/cyan] {title}", subtitle=date_str, subtitle_align="right", box=box.ROUNDED))
+        console.print(f"[dim]Найдено: {len(results)} за {elapsed:.1f} мс[/dim]")
+        pick = Prompt.ask("Номер для перехода в чат (Enter - новый поиск)", default="")
+        if pick.isdigit() and int(pick) in result_map:
+            view_thread(result_map[int(pick)])
+
+def highlight_terms(text, terms):
+    highlighted = Text(text)
+    for token in SEARCH_WORD_RE.finditer(text):
+        if any(stem_word(UserDirectory.normalize(token.group())).startswith(term) for term in terms):
+            highlighted.stylize("bold yellow", token.start(), token.end())
+    return highlighted
+
+def broadcast_message(thread_map):
+    selection = Prompt.ask("Номера чатов через запятую или 'all'")
+    if selection.strip().lower() == 'all':
+        thread_ids = list(thread_map.values())
+    else:
+        thread_ids = [thread_map[int(n)] for n in re.split(r'[,\s]+', selection) if n.isdigit() and int(n) in thread_map]
+    if not thread_ids:
+        console.print("[red]Чаты не выбраны[/red]")
+        return
+    text = Prompt.ask("[bold green]Текст рассылки[/bold green]")
+    if not text:
+        return
+    get_outbox().broadcast(thread_ids, text)
+    if api.offline:
+        console.print(f"[yellow]Нет связи: {len(thread_ids)} сообщений сохранены и будут отправлены позже[/yellow]")
+    else:
+        console.print(f"[green]Рассылка поставлена в очередь: {len(thread_ids)} чатов[/green]")
+    Prompt.ask("\nНажмите Enter, чтобы продолжить", default="")
+
+def view_thread(thread_id):
+    sync = get_chat_sync()
+    my_fio = current_user_fio()
+
+    updated = threading.Event()
+
+    def show_new(changed, new_messages):
+        if new_messages.get(thread_id):
+            updated.set()
+
+    chat_watcher.watch(sync, show_new)
+    chat_watcher.focus(sync, thread_id)
+    try:
+        thread_loop(sync, thread_id, my_fio, updated)
+    finally:
+        chat_watcher.focus(sync, None)
+        chat_watcher.unwatch(sync, show_new)
+
+def thread_loop(sync, thread_id, my_fio, updated):
+    needs_render = True
+    refresh = True
+    while True:
+        if refresh:
+            with console.status("Загрузка сообщений...", spinner="dots"):
+                try:
+                    if sync.sync_thread(thread_id):
+                        needs_render = True
+                    elif not needs_render:
+                        console.print("[dim]Новых сообщений нет[/dim]")
+                except Exception as e:
+                    console.print(f"[yellow]Не удалось обновить сообщения: {e}[/yellow]")
+            refresh = False
+
+        if updated.is_set() or notices.pending():
+            updated.clear()
+            needs_render = True
+        if needs_render:
+            render_thread([Message.from_json(m) for m in sync.store.messages(thread_id, limit=ChatSync.PAGE_SIZE)], my_fio)
+            for item in sync.store.outgoing(thread_id):
+                if item['status'] == 'failed':
+                    console.print(f"[red]✗ Не отправлено: {item['text']}[/red]", justify="right")
+                else:
+                    console.print(f"[dim]⏳ В очереди: {item['text']}[/dim]", justify="right")
+            needs_render = False
+        notices.flush()
+
+        console.print("\n[dim]'r' - ответить, 'u' - обновить, '0' - назад, Enter - показать новые сообщения.[/dim]")
+        choice = Prompt.ask("Действие", default="")
         if choice == '0': break
-        elif choice.lower() == 'u': continue
+        elif choice.lower() == 'u': refresh = True
         elif choice.lower() == 'r':
             text = Prompt.ask("[bold green]Ваше сообщение[/bold green]")
             if text:
-                api.send_message(thread_id, text)
-                console.print("[green]Отправлено![/green]")
-                time.sleep(0.5)
+                get_outbox().enqueue(thread_id, text)
+                needs_render = True
+                if api.offline:
+                    notices.add("[yellow]Нет связи: сообщение сохранено и будет отправлено позже[/yellow]")
+
+def current_user_fio():
+    if not api.profile_data:
+        return None
+    return f"{api.profile_data.get('lastName')} {api.profile_data.get('firstName')} {api.profile_data.get('middleName')}"
+
+def render_thread(messages, my_fio=None):
+    clear_screen()
+    print_header("Чат")
+    for msg in messages:
+        print_message(msg, my_fio)
+
+def print_message(msg, my_fio=None):
+    sender = msg.sender_fio or 'Неизвестный'
+    date = datetime.fromtimestamp(msg.create_date / 1000).strftime('%H:%M')
+    is_me = sender == my_fio
+    color = "green" if is_me else "yellow"
+    align = "right" if is_me else "left"
+    msg_panel = Panel(f"{msg.text}\n[dim]{date}[/dim]", title=f"[bold {color}]{sender}[/bold {color}]", title_align=align, border_style=color, width=60, expand=False)
+    console.print(msg_panel, justify="right" if is_me else "left")
 
 def build_period_tree(periods_list):
     children = {}
@@ -464,40 +3221,71 @@ def build_period_tree(periods_list):
     recurse(roots, 0)
     return result
 
+def load_period_options(aclient):
+    groups = [Group.from_json(g) for g in aclient.api.get_class_by_user() or []]
+    if not groups:
+        return []
+    
+    groups.sort(key=lambda g: g.beg_date)
+
+    all_options = []
+
+    periods_by_group = aclient.run(aclient.gather(
+        [aclient.get_periods(group.group_id) for group in groups],
+        limit=PERIODS_CONCURRENCY
+    ))
+
+    for group, periods_data in zip(groups, periods_by_group):
+        all_options.append(Period.from_json(periods_data, group.group_id, group.group_name, is_root=True))
+
+        flat_sub_periods = build_period_tree(periods_data.get('items', []))
+        
+        for p in flat_sub_periods:
+            all_options.append(Period.from_json(p, group.group_id, group.group_name, depth=p.get('depth', 0) + 1))
+
+    return all_options
+
+def find_current_option(options, now=None):
+    if now is None:
+        now = time.time() * 1000
+    current = None
+    for period in options:
+        if not period.is_root and period.contains(now):
+            current = period
+    return current
+
+def find_last_ended_option(options, now=None):
+    if now is None:
+        now = time.time() * 1000
+    ended = [p for p in options if not p.is_root and p.date2 < now]
+    return max(ended, key=lambda p: (p.date2, p.depth), default=None)
+
+def find_period_option(options, requested, now=None):
+    if now is None:
+        now = time.time() * 1000
+    requested = str(requested).strip()
+    matches = [
+        p for p in options
+        if not p.is_root and (str(p.period_id) == requested or (p.name or "").lower() == requested.lower())
+    ]
+    return max(matches, key=lambda p: (p.date1 <= now, p.date1 if p.date1 <= now else -p.date1), default=None)
+
+def recent_periods(options, period, count=1):
+    if count <= 1:
+        return [period]
+    earlier = {
+        p.period_id: p for p in options
+        if not p.is_root and p.depth == period.depth and p.date2 <= period.date2 and p.period_id != period.period_id
+    }
+    return sorted(earlier.values(), key=lambda p: p.date1)[-(count - 1):] + [period]
+
 def select_period_option():
     with console.status("Загрузка данных для всех классов...", spinner="dots"):
         try:
-            groups = api.get_class_by_user()
-            if not groups:
+            all_options = load_period_options(aapi)
+            if not all_options:
                 console.print("[red]Классы не найдены[/red]")
                 return None
-            
-            groups.sort(key=lambda x: x.get('begDate', 0))
-
-            all_options = []
-
-            for group in groups:
-                group_id = group['groupId']
-                group_name = group.get('groupName', f"Group {group_id}")
-                
-                periods_data = api.get_periods(group_id)
-                
-                root_period = periods_data.copy()
-                if 'items' in root_period:
-                    del root_period['items']
-                
-                root_period['depth'] = 0
-                root_period['is_root'] = True
-                root_period['group_name'] = group_name
-                
-                all_options.append({'period': root_period, 'group_id': group_id})
-
-                flat_sub_periods = build_period_tree(periods_data.get('items', []))
-                
-                for p in flat_sub_periods:
-                    p['depth'] = p.get('depth', 0) + 1
-                    all_options.append({'period': p, 'group_id': group_id})
-
             return all_options
 
         except Exception as e:
@@ -522,23 +3310,22 @@ def show_diary():
     current_option_idx = None
     now = time.time() * 1000
     
-    for idx, opt in enumerate(options, 1):
-        period_map[idx] = opt
-        p = opt['period']
-        name = p['name']
+    for idx, p in enumerate(options, 1):
+        period_map[idx] = p
+        name = p.name
         
-        prefix = "  " * p.get('depth', 0)
+        prefix = "  " * p.depth
         
-        if p.get('is_root'):
-            display_name = f"[bold blue]{p.get('group_name')}[/bold blue]: {name}"
+        if p.is_root:
+            display_name = f"[bold blue]{p.group_name}[/bold blue]: {name}"
         else:
             display_name = prefix + name
 
-        dates = f"{p['date1Str']} - {p['date2Str']}"
+        dates = f"{p.date1_str} - {p.date2_str}"
         style = "white"
         
-        if p['date1'] <= now <= p['date2']:
-            if not p.get('is_root'):
+        if p.contains(now):
+            if not p.is_root:
                  style = "bold yellow"
                  display_name = f"{prefix}{name} (Текущий)"
                  current_option_idx = str(idx)
@@ -546,51 +3333,70 @@ def show_diary():
         table.add_row(str(idx), display_name, dates)
         
     console.print(table)
+
+    prefetch_id = prefetch = None
+    if current_option_idx:
+        prefetch_id = period_map[int(current_option_idx)].period_id
+        prefetch = aapi.submit(aapi.get_diary_units(prefetch_id), aapi.get_diary_period(prefetch_id))
     
     default_val = current_option_idx if current_option_idx else "1"
     choice = Prompt.ask("Выберите номер", default=default_val)
     
     if not choice.isdigit() or int(choice) not in period_map: return
 
-    selected_opt = period_map[int(choice)]
-    selected_period = selected_opt['period']
-    selected_group_id = selected_opt['group_id']
+    selected_period = period_map[int(choice)]
+    selected_group_id = selected_period.group_id
     
     with console.status("Загрузка оценок...", spinner="dots"):
-        diary_units = api.get_diary_units(selected_period['id'])
-        units_list = diary_units.get('result', [])
-        
-        diary_details = api.get_diary_period(selected_period['id'])
-        lessons = diary_details.get('result', [])
+        diary_units = diary_details = None
+        if prefetch is not None and prefetch_id == selected_period.period_id:
+            try:
+                diary_units, diary_details = prefetch.result()
+            except Exception:
+                pass
+        if diary_units is None:
+            try:
+                diary_units, diary_details = aapi.run(
+                    aapi.get_diary_units(selected_period.period_id),
+                    aapi.get_diary_period(selected_period.period_id)
+                )
+            except ESchoolAPIError as e:
+                console.print(f"[red]Нет данных дневника: {e}[/red]")
+                Prompt.ask("Enter для возврата")
+                return
+        units_list = [Unit.from_json(u) for u in diary_units.get('result', [])]
+        lessons = [Lesson.from_json(l) for l in diary_details.get('result', [])]
 
     marks_map = {} 
     for lesson in lessons:
-        unit_id = lesson.get('unitId')
-        parts = lesson.get('part', [])
-        for part in parts:
-            marks = part.get('mark', [])
-            for mark in marks:
-                val = mark.get('markValue')
-                if val:
-                    if unit_id not in marks_map:
-                        marks_map[unit_id] = []
-                    marks_map[unit_id].append(val)
+        for part in lesson.parts:
+            for mark in part.marks:
+                if mark.value:
+                    if lesson.unit_id not in marks_map:
+                        marks_map[lesson.unit_id] = []
+                    marks_map[lesson.unit_id].append(mark.value)
 
     clear_screen()
-    print_header(f"Оценки: {selected_period['name']}")
+    print_header(f"Оценки: {selected_period.name}")
     
     table = Table(box=box.ROUNDED, show_lines=True)
     table.add_column("Предмет", style="bold white")
     table.add_column("Средний", justify="center", style="bold yellow")
     table.add_column("Оценки", style="white")
     table.add_column("Итог", justify="center", style="bold red")
+    table.add_column(f"Пятерок до {TARGET_AVERAGE}", justify="center", style="dim")
+
+    unit_marks = collect_marks(lessons)
+    weighted = {unit_id: weighted_average(marks) for unit_id, marks in unit_marks.items()}
     
     for unit in units_list:
-        name = unit.get('unitName')
-        unit_id = unit.get('unitId')
-        over_mark = unit.get('overMark')
+        name = unit.name
+        unit_id = unit.unit_id
+        over_mark = unit.over_mark
+        if not over_mark and unit_id in weighted:
+            over_mark = weighted[unit_id]
         avg_str = str(over_mark) if over_mark is not None and over_mark > 0 else "-"
-        total = unit.get('totalMark', '') or "-"
+        total = unit.total_mark or "-"
         current_marks = marks_map.get(unit_id, [])
         marks_str = " ".join(current_marks)
 
@@ -605,12 +3411,18 @@ def show_diary():
             name, 
             Text(avg_str, style=avg_style), 
             Text(marks_str, style="cyan"), 
-            Text(str(total), style="bold magenta" if total != '-' else "dim")
+            Text(str(total), style="bold magenta" if total != '-' else "dim"),
+            format_needed_marks(needed_marks(unit_marks[unit_id], TARGET_AVERAGE)) if unit_id in unit_marks else "-"
         )
         
     console.print(table)
     Prompt.ask("\nНажмите Enter, чтобы вернуться назад")
 
+def format_needed_marks(count):
+    if count is None:
+        return "—"
+    return "✓" if count == 0 else str(count)
+
 def show_homework():
     clear_screen()
     print_header("Домашнее задание")
@@ -628,74 +3440,130 @@ def show_homework():
     period_map = {}
     current_option_idx = None
     now = time.time() * 1000
-    for idx, opt in enumerate(options, 1):
-        period_map[idx] = opt
-        p = opt['period']
-        name = p['name']
-        prefix = "  " * p.get('depth', 0)
-        if p.get('is_root'):
-            display_name = f"[bold blue]{p.get('group_name')}[/bold blue]: {name}"
+    for idx, p in enumerate(options, 1):
+        period_map[idx] = p
+        name = p.name
+        prefix = "  " * p.depth
+        if p.is_root:
+            display_name = f"[bold blue]{p.group_name}[/bold blue]: {name}"
         else:
             display_name = prefix + name
         
-        if p['date1'] <= now <= p['date2']:
-             if not p.get('is_root'):
+        if p.contains(now):
+             if not p.is_root:
                 display_name = f"{prefix}{name} (Текущий)"
                 current_option_idx = str(idx)
 
-        table.add_row(str(idx), display_name, f"{p['date1Str']} - {p['date2Str']}")
+        table.add_row(str(idx), display_name, f"{p.date1_str} - {p.date2_str}")
     console.print(table)
     
     default_val = current_option_idx if current_option_idx else "1"
     choice = Prompt.ask("Выберите номер", default=default_val)
     if not choice.isdigit() or int(choice) not in period_map: return
     
-    selected_opt = period_map[int(choice)]
-    selected_period = selected_opt['period']
-    
-    with console.status("Загрузка домашнего задания...", spinner="dots"):
-        diary_data = api.get_prs_diary(selected_period['date1'], selected_period['date2'])
-        lessons = diary_data.get('lesson', [])
+    selected_period = period_map[int(choice)]
     
     clear_screen()
-    print_header(f"ДЗ: {selected_period['name']}")
-    
-    hw_table = Table(box=box.ROUNDED, show_lines=True)
-    hw_table.add_column("Дата", style="cyan", width=12)
-    hw_table.add_column("Предмет", style="bold white", width=20)
-    hw_table.add_column("Задание", style="white")
-    hw_table.add_column("Файлы", style="blue")
+    print_header(f"ДЗ: {selected_period.name}")
 
     has_hw = False
-    lessons.sort(key=lambda x: x.get('date', 0))
+    seen_lessons = set()
+    attachments = []
+    load_error = None
+    windows = api.iter_prs_diary(selected_period.date1, selected_period.date2)
+    while True:
+        with console.status("Загрузка домашнего задания...", spinner="dots"):
+            try:
+                window = next(windows, None)
+            except ESchoolAPIError as e:
+                load_error = e
+                window = None
+        if window is None:
+            break
+        _, diary_data = window
+        lessons = []
+        for lesson_data in diary_data.get('lesson', []):
+            lesson = Lesson.from_json(lesson_data)
+            if lesson.lesson_id is not None and lesson.lesson_id in seen_lessons:
+                continue
+            seen_lessons.add(lesson.lesson_id)
+            lessons.append(lesson)
 
-    for lesson in lessons:
-        date_ts = lesson.get('date')
-        date_str = datetime.fromtimestamp(date_ts / 1000).strftime('%d.%m.%Y')
-        subject = lesson.get('unit', {}).get('name', 'Неизвестно')
-        
-        parts = lesson.get('part', [])
-        for part in parts:
-            if part.get('cat') == 'DZ':
-                variants = part.get('variant', [])
-                for variant in variants:
-                    text_html = variant.get('text', '')
-                    clean_text = clean_html(text_html)
-                    
-                    files = variant.get('file', [])
-                    file_names = "\n".join([f.get('fileName') for f in files])
-                    
-                    if clean_text or file_names:
-                        hw_table.add_row(date_str, subject, clean_text, file_names)
-                        has_hw = True
+        hw_table = Table(box=box.ROUNDED, show_lines=True, show_header=not has_hw, expand=True)
+        hw_table.add_column("Дата", style="cyan", width=12)
+        hw_table.add_column("Предмет", style="bold white", width=20)
+        hw_table.add_column("Задание", style="white", ratio=3)
+        hw_table.add_column("Файлы", style="blue", ratio=1)
+        lessons.sort(key=lambda x: x.date)
 
-    if has_hw:
-        console.print(hw_table)
-    else:
-        console.print(Panel("Домашних заданий за этот период не найдено", style="yellow"))
+        for lesson in lessons:
+            date_str = datetime.fromtimestamp(lesson.date / 1000).strftime('%d.%m.%Y')
+            subject = lesson.unit_name or 'Неизвестно'
+            
+            for part in lesson.parts:
+                if part.cat == 'DZ':
+                    for variant in part.variants:
+                        clean_text = clean_html(variant.text)
+                        file_names = "\n".join(f.name for f in variant.files)
+                        attachments.extend((date_str, subject, f) for f in variant.files)
+                        
+                        if clean_text or file_names:
+                            hw_table.add_row(date_str, subject, clean_text, file_names)
+
+        if hw_table.row_count:
+            console.print(hw_table)
+            has_hw = True
+
+    if load_error is not None:
+        console.print(Panel(f"Не удалось загрузить домашние задания: {load_error}", style="red"))
+    if not has_hw:
+        if load_error is None:
+            console.print(Panel("Домашних заданий за этот период не найдено", style="yellow"))
+    elif attachments and Confirm.ask(f"\nСкачать вложения ({len(attachments)})?", default=False):
+        folder = Prompt.ask("Папка для файлов", default=os.path.join("eschool_export", export_name(selected_period.name)))
+        download_homework_files(attachments, folder)
 
     Prompt.ask("\nНажмите Enter, чтобы вернуться назад")
 
+def export_name(name):
+    return EXPORT_NAME_RE.sub("_", str(name)).strip(" .") or "file"
+
+def download_homework_files(attachments, folder):
+    downloader = AttachmentDownloader(api)
+    items = [("HOMEWORK_VARIANT", f.variant_id, f.file_id, export_name(f"{date_str} {subject} - {f.name}"))
+             for date_str, subject, f in attachments]
+    used_names = {}
+    done = failed = 0
+    with console.status("Скачивание вложений...", spinner="dots") as status:
+        for item, meta, error in downloader.fetch_many(items):
+            if error is not None:
+                failed += 1
+                status.update(f"Скачивание вложений... {done + failed}/{len(items)}")
+                console.print(f"[red]{item[3]}: {error}[/red]")
+                continue
+            name = item[3]
+            stem, ext = os.path.splitext(name)
+            n = 1
+            while used_names.get(name, meta['sha256']) != meta['sha256']:
+                n += 1
+                name = f"{stem} ({n}){ext}"
+            try:
+                downloader.store.export(meta['sha256'], os.path.join(folder, name))
+            except OSError as e:
+                failed += 1
+                console.print(f"[red]{name}: {e}[/red]")
+                continue
+            used_names[name] = meta['sha256']
+            done += 1
+            status.update(f"Скачивание вложений... {done + failed}/{len(items)}")
+
+    console.print(
+        f"[green]Сохранено файлов: {len(used_names)} в {folder}[/green] "
+        f"(уникальных: {len(set(used_names.values()))}, загружено {downloader.downloaded_bytes / 1024:.0f} КиБ)"
+    )
+    if failed:
+        console.print(f"[yellow]Не удалось скачать: {failed}. Повторный запуск докачает их.[/yellow]")
+
 def show_pupil_units():
     clear_screen()
     print_header("Предметы")
@@ -703,15 +3571,7 @@ def show_pupil_units():
     if not api.prs_id:
         api.get_state()
     
-    year_id = None
-    try:
-        profile = api.get_profile_new(api.prs_id)
-        pupils = profile.get('pupil', [])
-        if pupils:
-            pupils_sorted = sorted(pupils, key=lambda x: x.get('bvt', ''), reverse=True)
-            year_id = str(pupils_sorted[0].get('yearId', ''))
-    except:
-        pass
+    year_id = str(lookup_year_id() or '')
     
     if not year_id or not year_id.isdigit():
         year_id = Prompt.ask("[bold cyan]Введите ID учебного года[/bold cyan] (например, 88749)", default="88749")
@@ -758,15 +3618,7 @@ def show_homework_new():
     if not api.prs_id:
         api.get_state()
     
-    year_id = None
-    try:
-        profile = api.get_profile_new(api.prs_id)
-        pupils = profile.get('pupil', [])
-        if pupils:
-            pupils_sorted = sorted(pupils, key=lambda x: x.get('bvt', ''), reverse=True)
-            year_id = str(pupils_sorted[0].get('yearId', ''))
-    except:
-        pass
+    year_id = str(lookup_year_id() or '')
     
     if not year_id or not year_id.isdigit():
         year_id = Prompt.ask("[bold cyan]Введите ID учебного года[/bold cyan]", default="88749")
@@ -915,54 +3767,69 @@ def show_profile_extended():
 def show_user_search():
     clear_screen()
     print_header("Поиск пользователей")
-    
-    year_id = Prompt.ask("[bold cyan]Введите ID учебного года[/bold cyan]", default="88749")
+
+    default_year = lookup_year_id()
+    year_id = Prompt.ask("[bold cyan]Введите ID учебного года[/bold cyan]", default=str(default_year or "88749"))
     if not year_id.isdigit():
         console.print("[red]Неверный ID года[/red]")
         Prompt.ask("\nНажмите Enter, чтобы вернуться назад")
         return
     
-    with console.status("Поиск пользователей...", spinner="dots"):
+    with console.status("Загрузка справочника пользователей...", spinner="dots"):
         try:
-            users = api.get_user_list_search(int(year_id))
-            
-            if not users:
-                console.print(Panel("Пользователи не найдены", style="yellow"))
-                Prompt.ask("\nНажмите Enter, чтобы вернуться назад")
-                return
-            
-            students = [u for u in users if u.get('isStudent') == 1]
-            teachers = [u for u in users if u.get('isEmp') == 1]
-            parents = [u for u in users if u.get('isParent') == 1]
-            
-            console.print(f"\n[bold cyan]Найдено:[/bold cyan]")
-            console.print(f"  👨‍🎓 Учеников: {len(students)}")
-            console.print(f"  👨‍🏫 Преподавателей: {len(teachers)}")
-            console.print(f"  👨‍👩‍👧 Родителей: {len(parents)}")
-            
-            if students:
-                console.print("\n[bold cyan]Ученики (первые 20):[/bold cyan]")
-                student_table = Table(box=box.ROUNDED, show_lines=True)
-                student_table.add_column("ID", justify="right", style="cyan", width=8)
-                student_table.add_column("ФИО", style="bold white")
-                student_table.add_column("Класс", style="green")
-                
-                for student in students[:20]:
-                    prs_id = student.get('prsId', '')
-                    fio = student.get('fio', 'Неизвестно')
-                    group_name = student.get('groupName', '-')
-                    student_table.add_row(str(prs_id), fio, group_name)
-                
-                console.print(student_table)
-        
+            directory = load_user_directory(api, int(year_id))
         except Exception as e:
             console.print(f"[red]Ошибка: {e}[/red]")
-    
-    Prompt.ask("\nНажмите Enter, чтобы вернуться назад")
+            Prompt.ask("\nНажмите Enter, чтобы вернуться назад")
+            return
+
+    if not directory.users:
+        console.print(Panel("Пользователи не найдены", style="yellow"))
+        Prompt.ask("\nНажмите Enter, чтобы вернуться назад")
+        return
+
+    console.print(f"\n[bold cyan]Найдено:[/bold cyan]")
+    console.print(f"  👨‍🎓 Учеников: {directory.count(role='student')}")
+    console.print(f"  👨‍🏫 Преподавателей: {directory.count(role='teacher')}")
+    console.print(f"  👨‍👩‍👧 Родителей: {directory.count(role='parent')}")
+
+    role_names = {'student': "Ученик", 'teacher': "Преподаватель", 'parent': "Родитель"}
+    role_filters = {'у': 'student', 'п': 'teacher', 'р': 'parent'}
+    result_map = {}
+    while True:
+        console.print("\n[dim]Введите часть ФИО (можно с фильтром: 'у:', 'п:', 'р:'), номер для сообщения или '0' для выхода[/dim]")
+        query = Prompt.ask("Поиск").strip()
+        if query == '0' or not query:
+            break
+        if query.isdigit() and int(query) in result_map:
+            open_chat_with_user(result_map[int(query)])
+            break
+
+        role = None
+        if len(query) > 2 and query[1] == ':' and query[0].lower() in role_filters:
+            role = role_filters[query[0].lower()]
+            query = query[2:]
+
+        results = directory.search(query, role=role)
+        result_map = {}
+        if not results:
+            console.print("[yellow]Никого не найдено[/yellow]")
+            continue
 
-def open_chat_with_user(user_data):
-    prs_id = user_data.get('prsId')
-    fio = user_data.get('fio')
+        table = Table(box=box.ROUNDED, show_lines=True)
+        table.add_column("#", justify="right", style="cyan", width=4)
+        table.add_column("ФИО", style="bold white")
+        table.add_column("Класс", style="green")
+        table.add_column("Роль", style="yellow")
+        for idx, user in enumerate(results, 1):
+            result_map[idx] = user
+            roles = ", ".join(role_names.get(r, r) for r in user.roles) or "-"
+            table.add_row(str(idx), user.fio, user.group_name or "-", roles)
+        console.print(table)
+
+def open_chat_with_user(user):
+    prs_id = user.prs_id
+    fio = user.fio
     
     if not prs_id:
         console.print("[red]Ошибка: нет ID пользователя[/red]")
@@ -973,118 +3840,148 @@ def open_chat_with_user(user_data):
     
     with console.status(f"Открытие чата с {fio}...", spinner="dots"):
         try:
-            thread_data = api.save_thread(prs_id)
-            if isinstance(thread_data, int) or (isinstance(thread_data, str) and thread_data.isdigit()):
-                thread_id = int(thread_data)
-                view_thread(thread_id)
-            else:
-                console.print(f"[red]Не удалось получить ID чата. Ответ: {thread_data}[/red]")
-                Prompt.ask("Нажмите Enter")
+            thread_id = get_chat_sync().open_thread(prs_id)
         except Exception as e:
             console.print(f"[red]Ошибка при открытии чата: {e}[/red]")
             Prompt.ask("Нажмите Enter")
+            return
+    view_thread(thread_id)
+
+def message_group(tree, node):
+    members = [user for user in tree.members(node) if user.prs_id and user.prs_id != api.prs_id]
+    if not members:
+        console.print("[yellow]В группе нет пользователей[/yellow]")
+        Prompt.ask("Нажмите Enter")
+        return
+    action = Prompt.ask(
+        f"\n[bold cyan]{tree.names[node]}[/bold cyan] · {len(members)} чел.:\n"
+        "1. Написать каждому лично\n"
+        "2. Создать групповой чат\n"
+        "0. Отмена\n"
+        "Выбор",
+        choices=["1", "2", "0"]
+    )
+    sync = get_chat_sync()
+    if action == "1":
+        text = Prompt.ask("[bold green]Текст сообщения[/bold green]")
+        if not text:
+            return
+        with console.status(f"Открытие чатов ({len(members)})...", spinner="dots"):
+            threads, errors = sync.open_threads(user.prs_id for user in members)
+        get_outbox().broadcast(threads.values(), text)
+        console.print(f"[green]Сообщение поставлено в очередь: {len(threads)} чатов[/green]")
+        names = {user.prs_id: user.fio for user in members}
+        for prs_id, error in errors.items():
+            console.print(f"[red]Не удалось открыть чат с {names[prs_id]}: {error}[/red]")
+        Prompt.ask("\nНажмите Enter, чтобы продолжить", default="")
+    elif action == "2":
+        subject = Prompt.ask("Название чата", default=tree.names[node])
+        with console.status("Создание группового чата...", spinner="dots"):
+            try:
+                thread_id = sync.create_group(subject, members)
+            except Exception as e:
+                console.print(f"[red]Ошибка при создании чата: {e}[/red]")
+                Prompt.ask("Нажмите Enter")
+                return
+        view_thread(thread_id)
 
 
+def school_tree_action(tree, node):
+    action = Prompt.ask(
+        f"\nДействия с [bold cyan]{tree.names[node]}[/bold cyan]:\n"
+        "1. Написать сообщение\n"
+        "0. Отмена\n"
+        "Выбор",
+        choices=["1", "0"]
+    )
+    if action == "1":
+        open_chat_with_user(tree.user(node))
+
+def print_school_nodes(tree, nodes, show_path=False):
+    table = Table(box=box.SIMPLE, show_lines=True)
+    table.add_column("#", style="cyan", width=4)
+    table.add_column("Тип", style="dim", width=10)
+    table.add_column("Название / ФИО", style="bold white")
+    if show_path:
+        table.add_column("Расположение", style="dim")
+
+    item_map = {}
+    for idx, node in enumerate(nodes, 1):
+        item_map[idx] = node
+        name_str = tree.names[node]
+        if tree.kind[node] == SchoolTree.USER:
+            if tree.positions[node]:
+                name_str += f" [dim]({tree.positions[node]})[/dim]"
+        elif tree.user_count[node]:
+            name_str += f" [dim]· {tree.user_count[node]}[/dim]"
+        row = [str(idx), SchoolTree.KIND_LABELS.get(tree.kind[node], ""), name_str]
+        if show_path:
+            row.append(" / ".join(tree.names[n] for n in tree.path(tree.parent[node])))
+        table.add_row(*row)
+    console.print(table)
+    return item_map
+
 def show_school_tree():
-    current_level_data = None
-    path_history = []
-    
     with console.status("Загрузка структуры школы...", spinner="dots"):
         try:
-            tree_data = api.get_groups_tree()
-            current_level_data = tree_data
+            tree = SchoolTree(api.get_groups_tree())
         except Exception as e:
             console.print(f"[red]Ошибка загрузки справочника: {e}[/red]")
             Prompt.ask("Нажмите Enter")
             return
 
+    current = 0
     while True:
         clear_screen()
-        path_names = [p.get('groupName', 'Root') or p.get('groupTypeName', 'Root') or p.get('orgName', 'Root') for p in path_history]
+        path_names = [tree.names[n] for n in tree.path(current)]
         title = " / ".join(path_names) if path_names else "Справочник школы"
         print_header(title)
 
-        items = []
-        
-        if isinstance(current_level_data, list):
-            items = current_level_data
-        elif isinstance(current_level_data, dict):
-            if 'groups' in current_level_data:
-                items.extend(current_level_data['groups'])
-            if 'users' in current_level_data:
-                items.extend(current_level_data['users'])
-        
-        if not items:
+        children = tree.children(current)
+        if not children:
             console.print("[yellow]В этой категории пусто.[/yellow]")
-        
-        table = Table(box=box.SIMPLE, show_lines=True)
-        table.add_column("#", style="cyan", width=4)
-        table.add_column("Тип", style="dim", width=10)
-        table.add_column("Название / ФИО", style="bold white")
-        
-        item_map = {}
-        idx = 1
-        
-        for item in items:
-            item_map[idx] = item
-            
-            type_str = ""
-            name_str = ""
-            
-            if 'orgName' in item:
-                type_str = "🏢 Орг."
-                name_str = item['orgName']
-            elif 'groupTypeName' in item and 'groupName' not in item: 
-                 type_str = "📂 Кат."
-                 name_str = item['groupTypeName']
-            elif 'groupName' in item:
-                type_str = "👥 Группа"
-                name_str = item['groupName']
-            elif 'fio' in item:
-                type_str = "👤 Польз."
-                name_str = item['fio']
-                if 'pos' in item and item['pos']:
-                    pos_names = [p.get('posTypeName', '') for p in item['pos']]
-                    name_str += f" [dim]({', '.join(filter(None, pos_names))})[/dim]"
-            
-            table.add_row(str(idx), type_str, name_str)
-            idx += 1
-            
-        console.print(table)
-        console.print("\n[dim]Введите номер для перехода, 'b' назад, '0' выход в меню[/dim]")
+
+        item_map = print_school_nodes(tree, children)
+        hint = ", 'm' написать всем" if current and tree.user_count[current] else ""
+        console.print(f"\n[dim]Введите номер для перехода, 's' поиск{hint}, 'b' назад, '0' выход в меню[/dim]")
         
         choice = Prompt.ask("Выбор")
         
         if choice == '0':
             break
+        elif choice.lower() == 'm' and hint:
+            message_group(tree, current)
         elif choice.lower() == 'b':
-            if path_history:
-                path_history.pop()
-                if not path_history:
-                    current_level_data = tree_data
-                else:
-                    current_level_data = path_history[-1]
+            if current:
+                current = tree.parent[current]
             else:
                 break
+        elif choice.lower() == 's':
+            query = Prompt.ask("ФИО, должность или название группы")
+            results = tree.search(query)
+            if not results:
+                console.print("[yellow]Ничего не найдено[/yellow]")
+                Prompt.ask("Нажмите Enter")
+                continue
+            result_map = print_school_nodes(tree, results, show_path=True)
+            pick = Prompt.ask("Номер (Enter - назад)", default="")
+            if pick.isdigit() and int(pick) in result_map:
+                node = result_map[int(pick)]
+                if tree.kind[node] == SchoolTree.USER:
+                    school_tree_action(tree, node)
+                else:
+                    current = node
         elif choice.isdigit() and int(choice) in item_map:
-            selected_item = item_map[int(choice)]
-            
-            if 'fio' in selected_item:
-                action = Prompt.ask(
-                    f"\nДействия с [bold cyan]{selected_item['fio']}[/bold cyan]:\n"
-                    "1. Написать сообщение\n"
-                    "0. Отмена\n"
-                    "Выбор",
-                    choices=["1", "0"]
-                )
-                if action == "1":
-                    open_chat_with_user(selected_item)
+            node = item_map[int(choice)]
+            if tree.kind[node] == SchoolTree.USER:
+                school_tree_action(tree, node)
             else:
-                path_history.append(selected_item)
-                current_level_data = selected_item
+                current = node
 
 
 def main_menu():
+    if api.username:
+        get_outbox()
     while True:
         clear_screen()
         print_header()
@@ -1110,27 +4007,228 @@ def main_menu():
         
         panel = Panel(menu_table, title="Меню", border_style="blue", padding=(1, 2))
         console.print(panel, justify="center")
+        notices.flush()
         
         choice = Prompt.ask("\nВаш выбор", choices=["1", "2", "3", "4", "5", "6", "7", "8", "9", "0"])
         
-        if choice == "1": show_diary()
-        elif choice == "2": show_chats()
-        elif choice == "3": show_profile()
-        elif choice == "4": show_homework()
-        elif choice == "5": show_pupil_units()
-        elif choice == "6": show_homework_new()
-        elif choice == "7": show_user_search()
-        elif choice == "8": show_profile_extended()
-        elif choice == "9": show_school_tree()
-        elif choice == "0":
+        if choice == "0":
             if Confirm.ask("Вы уверены, что хотите выйти?"):
                 console.print("[yellow]До свидания![/yellow]")
                 break
+            continue
+
+        screen = MENU_SCREENS[choice]
+        with api.screen(screen.__name__):
+            screen()
+
+MENU_SCREENS = {
+    "1": show_diary,
+    "2": show_chats,
+    "3": show_profile,
+    "4": show_homework,
+    "5": show_pupil_units,
+    "6": show_homework_new,
+    "7": show_user_search,
+    "8": show_profile_extended,
+    "9": show_school_tree,
+}
+
+def batch_fetch_marks(client, periods):
+    return client.get_diary_units(periods[-1].period_id).get('result', [])
+
+def batch_fetch_diary(client, periods):
+    return client.get_diary_period(periods[-1].period_id).get('result', [])
+
+def batch_fetch_homework(client, periods):
+    period = periods[-1]
+    lessons = []
+    for _, diary_data in client.iter_prs_diary(period.date1, period.date2):
+        lessons.extend(diary_data.get('lesson', []))
+    return lessons
+
+def batch_fetch_averages(client, periods):
+    marks_by_period = []
+    all_marks = {}
+    for period in periods:
+        lessons = [Lesson.from_json(l) for l in client.get_diary_period(period.period_id).get('result', [])]
+        unit_marks = collect_marks(lessons)
+        marks_by_period.append((period.period_id, unit_marks))
+        for unit_id, marks in unit_marks.items():
+            all_marks.setdefault(unit_id, []).extend(marks)
+    current = marks_by_period[-1][1]
+    trends = period_averages(marks_by_period)
+    result = {}
+    for unit_id, marks in all_marks.items():
+        marks.sort(key=lambda mark: mark[0])
+        result[str(unit_id)] = {
+            "weighted": weighted_average(marks),
+            "by_type": {
+                mark_type or "": {"weighted": average, "count": count}
+                for mark_type, (average, count) in averages_by_type(marks).items()
+            },
+            "moving_average": moving_average(marks),
+            "periods": {str(period_id): average for period_id, average in trends.get(unit_id, {}).items()},
+            "trend": round(marks_slope(marks), 4),
+            "needed_for_target": needed_marks(current.get(unit_id, []), TARGET_AVERAGE)
+        }
+    return result
+
+def batch_fetch_chats(client, periods):
+    return client.get_threads()
+
+BATCH_FETCHERS = {
+    "marks": batch_fetch_marks,
+    "diary": batch_fetch_diary,
+    "homework": batch_fetch_homework,
+    "averages": batch_fetch_averages,
+    "chats": batch_fetch_chats,
+}
+
+def batch_login(client, account, session_pool):
+    username = account['username']
+    with session_pool.locked(username):
+        if client.auto_login():
+            return True
+        if account.get('password'):
+            return client.login(username, account['password'])
+        if account.get('password_hash'):
+            return client.login_with_hash(username, account['password_hash'])
+        return False
+
+def run_batch_account(account, fetches, session_pool, rate_limiter, circuit_breaker, cache, offline, hooks=(),
+                      average_periods=1, requested_period=None):
+    started = time.monotonic()
+    username = account.get('username')
+    record = {"username": username, "ok": False}
+    client = session_pool.client(username, pool_size=PERIODS_CONCURRENCY)
+    client.rate_limiter = rate_limiter
+    client.circuit_breaker = circuit_breaker
+    client.cache = cache
+    client.offline = offline
+    client.hooks = list(hooks)
+    aclient = AsyncESchoolAPI(client, max_connections=PERIODS_CONCURRENCY)
+    try:
+        if not username or not batch_login(client, account, session_pool):
+            raise Exception("Не удалось войти")
+        client.get_state()
+
+        periods = []
+        if any(name != "chats" for name in fetches):
+            options = load_period_options(aclient)
+            if requested_period is not None:
+                period = find_period_option(options, requested_period)
+                if period is None:
+                    raise Exception(f"Период «{requested_period}» не найден")
+                source = "requested"
+            else:
+                period, source = find_current_option(options), "current"
+                if period is None:
+                    period, source = find_last_ended_option(options), "last_ended"
+                if period is None:
+                    raise Exception("Не найден ни текущий, ни завершенный период")
+            record["period"] = dict(period.to_json(), source=source)
+            periods = recent_periods(options, period, average_periods if "averages" in fetches else 1)
+            if len(periods) > 1:
+                record["periods"] = [p.to_json() for p in periods]
+
+        record["data"] = {name: BATCH_FETCHERS[name](client, periods) for name in fetches}
+        record["ok"] = True
+    except Exception as e:
+        record["error"] = str(e)
+    finally:
+        aclient.close()
+    record["elapsed"] = round(time.monotonic() - started, 3)
+    return record
+
+def run_batch(args):
+    fetches = [name.strip() for name in args.fetch.split(",") if name.strip()]
+    unknown = [name for name in fetches if name not in BATCH_FETCHERS]
+    if unknown:
+        print(f"Неизвестные данные для загрузки: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+
+    with open(args.accounts, 'r', encoding='utf-8') as f:
+        accounts = [json.loads(line) for line in f if line.strip()]
+
+    session_pool = SessionPool()
+    rate_limiter = RateLimiter(args.rate) if args.rate > 0 else None
+    circuit_breaker = CircuitBreaker()
+    cache = ResponseCache() if args.offline or not args.no_cache else None
+    hooks = instrumentation_hooks(args)
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    failures = 0
+    try:
+        with ThreadPoolExecutor(max_workers=args.jobs, thread_name_prefix="eschool-batch") as executor:
+            futures = [
+                executor.submit(run_batch_account, account, fetches, session_pool, rate_limiter, circuit_breaker, cache,
+                                args.offline, hooks, args.average_periods, args.period)
+                for account in accounts
+            ]
+            for future in as_completed(futures):
+                record = future.result()
+                if not record["ok"]:
+                    failures += 1
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        report_instrumentation(args, hooks, LazyObject(functools.partial(Console, stderr=True)))
+    return 1 if failures else 0
+
+def instrumentation_hooks(args):
+    hooks = []
+    if args.profile or args.metrics:
+        hooks.append(RequestMetrics())
+    if args.trace:
+        hooks.append(SpanRecorder(args.trace))
+    return hooks
+
+def report_instrumentation(args, hooks, out):
+    for hook in hooks:
+        if isinstance(hook, RequestMetrics):
+            if args.metrics:
+                with open(args.metrics, 'w', encoding='utf-8') as f:
+                    f.write(hook.prometheus_text())
+            if args.profile:
+                hook.print_profile(out)
+        elif isinstance(hook, SpanRecorder):
+            hook.close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="eSchool CLI")
+    parser.add_argument("--offline", action="store_true", help="работать только с сохраненными данными")
+    parser.add_argument("--no-cache", action="store_true", help="не использовать кэш ответов сервера")
+    parser.add_argument("--profile", action="store_true", help="при выходе показать, сколько запросов и времени ушло на каждый экран")
+    parser.add_argument("--metrics", help="при выходе записать метрики запросов в файл в формате Prometheus")
+    parser.add_argument("--trace", help="записывать спаны запросов (в духе OpenTelemetry) в JSONL-файл")
+    subparsers = parser.add_subparsers(dest="command")
+
+    batch = subparsers.add_parser("batch", help="загрузить данные для списка аккаунтов без интерфейса")
+    batch.add_argument("accounts", help="JSONL-файл с полями username и password (или password_hash)")
+    batch.add_argument("--jobs", type=int, default=4, help="число аккаунтов, обрабатываемых параллельно")
+    batch.add_argument("--fetch", default="marks,diary,homework,chats", help="что загружать: " + ",".join(BATCH_FETCHERS))
+    batch.add_argument("--rate", type=float, default=10.0, help="максимум запросов в секунду к серверу (0 - без ограничения)")
+    batch.add_argument("--output", help="файл для NDJSON-результатов (по умолчанию stdout)")
+    batch.add_argument("--period", help="ID или название периода (по умолчанию текущий, а вне учебных периодов - последний завершенный)")
+    batch.add_argument("--average-periods", type=int, default=1,
+                       help="сколько последних периодов того же уровня учитывать в averages (включая текущий)")
+    return parser.parse_args(argv)
 
 def run():
+    args = parse_args()
+    if args.command == "batch":
+        sys.exit(run_batch(args))
+
+    if args.offline or not args.no_cache:
+        api.cache = ResponseCache()
+    api.offline = args.offline
+    api.hooks = instrumentation_hooks(args)
     try:
         while True:
-            if login_screen():
+            with api.screen("login_screen"):
+                logged_in = login_screen()
+            if logged_in:
                 main_menu()
                 break 
             else:
@@ -1138,6 +4236,8 @@ def run():
     except KeyboardInterrupt:
         console.print("\n[yellow]Принудительное завершение работы.[/yellow]")
         sys.exit(0)
+    finally:
+        report_instrumentation(args, api.hooks, console)
 
 if __name__ == "__main__":
     run()